@@ -0,0 +1,772 @@
+import base64
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+from graphql import build_schema, graphql_sync
+
+# Local stand-ins for the GitHub GraphQL/REST APIs and Slack, serving a
+# synthetic board. Every request is recorded with the phase of the sync loop
+# it belongs to, so run.py can report request counts and bytes per phase.
+
+datetime_format = "%Y-%m-%dT%H:%M:%SZ"
+
+OPTIONS = ["Backlog", "Todo", "In Progress", "Review", "Done"]
+PRIORITIES = ["P0", "P1", "P2", "P3"]
+
+SCHEMA = build_schema(
+    """
+    type Query {
+        rateLimit: RateLimit
+        organization(login: String!): Organization
+        node(id: ID!): Node
+        nodes(ids: [ID!]!): [Node]
+    }
+
+    type RateLimit {
+        cost: Int
+        remaining: Int
+    }
+
+    interface Node {
+        id: ID!
+    }
+
+    type Organization implements Node {
+        id: ID!
+        login: String!
+        name: String
+        projectNext(number: Int!): ProjectNext
+        projectV2(number: Int!): ProjectV2
+        project(number: Int!): Project
+    }
+
+    type PageInfo {
+        hasNextPage: Boolean!
+        endCursor: String
+    }
+
+    type ProjectNext implements Node {
+        id: ID!
+        number: Int!
+        title: String
+        url: String
+        owner: Organization
+        fields(first: Int): ProjectNextFieldConnection
+        items(first: Int, after: String): ProjectNextItemConnection
+    }
+
+    type ProjectV2 implements Node {
+        id: ID!
+    }
+
+    type ProjectNextField {
+        id: ID!
+        name: String
+        settings: String
+    }
+
+    type ProjectNextFieldConnection {
+        nodes: [ProjectNextField]
+    }
+
+    type ProjectNextItemConnection {
+        totalCount: Int!
+        pageInfo: PageInfo!
+        edges: [ProjectNextItemEdge]
+        nodes: [ProjectNextItem]
+    }
+
+    type ProjectNextItemEdge {
+        cursor: String!
+        node: ProjectNextItem
+    }
+
+    type ProjectNextItem implements Node {
+        id: ID!
+        project: ProjectNext
+        content: ProjectNextItemContent
+        fieldValues(first: Int): ProjectNextItemFieldValueConnection
+    }
+
+    union ProjectNextItemContent = Issue | PullRequest
+
+    type ProjectNextItemFieldValue {
+        projectField: ProjectNextField
+        value: String
+    }
+
+    type ProjectNextItemFieldValueConnection {
+        nodes: [ProjectNextItemFieldValue]
+    }
+
+    type Project implements Node {
+        id: ID!
+        databaseId: Int
+        number: Int!
+        name: String
+        url: String
+        body: String
+        columns(first: Int, after: String): ProjectColumnConnection
+    }
+
+    type ProjectColumnConnection {
+        pageInfo: PageInfo!
+        nodes: [ProjectColumn]
+    }
+
+    type ProjectColumn implements Node {
+        id: ID!
+        databaseId: Int
+        name: String
+        cards(first: Int, after: String, archivedStates: [ProjectCardArchivedState]): ProjectCardConnection
+    }
+
+    enum ProjectCardArchivedState {
+        ARCHIVED
+        NOT_ARCHIVED
+    }
+
+    type ProjectCardConnection {
+        pageInfo: PageInfo!
+        nodes: [ProjectCard]
+    }
+
+    type ProjectCard {
+        content: ProjectCardItem
+    }
+
+    union ProjectCardItem = Issue | PullRequest
+
+    type Repository {
+        name: String
+        nameWithOwner: String
+    }
+
+    type Label {
+        name: String
+    }
+
+    type LabelConnection {
+        nodes: [Label]
+    }
+
+    type Actor {
+        login: String
+    }
+
+    type IssueComment {
+        id: ID!
+        databaseId: Int
+        createdAt: String
+        updatedAt: String
+        body: String
+        url: String
+        author: Actor
+    }
+
+    type IssueCommentConnection {
+        nodes: [IssueComment]
+    }
+
+    type Issue implements Node {
+        id: ID!
+        databaseId: Int
+        number: Int
+        title: String
+        url: String
+        bodyUrl: String
+        state: String
+        repository: Repository
+        labels(first: Int): LabelConnection
+        comments(first: Int, last: Int): IssueCommentConnection
+        projectNextItems(first: Int): ProjectNextItemConnection
+    }
+
+    type PullRequest implements Node {
+        id: ID!
+        databaseId: Int
+        number: Int
+        title: String
+        url: String
+        state: String
+        repository: Repository
+        labels(first: Int): LabelConnection
+    }
+    """
+)
+
+
+def encode_cursor(offset):
+    return base64.b64encode(("cursor:%s" % offset).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    if cursor is None:
+        return 0
+    return int(base64.b64decode(cursor).decode("utf-8").split(":")[1])
+
+
+def paginate(records, first, after, to_node):
+    start = decode_cursor(after)
+    page = records[start:start + (first or 100)]
+    end = start + len(page)
+    # Nodes are only built when the query selects them, so pageInfo-only pages stay cheap.
+    return {
+        "totalCount": len(records),
+        "pageInfo": {"hasNextPage": end < len(records), "endCursor": encode_cursor(end) if page else after},
+        "edges": lambda info: [{"cursor": encode_cursor(start + i + 1), "node": to_node(r)} for i, r in enumerate(page)],
+        "nodes": lambda info: [to_node(record) for record in page],
+    }
+
+
+class Board:
+    """A synthetic board, shared by the ProjectNext and classic views."""
+
+    def __init__(self, size, seed=0, repos=10, labelled=0.2):
+        self.random = random.Random(seed)
+        self.repos = ["bench/repo-%s" % i for i in range(repos)]
+        self.labelled = labelled
+        self.next_number = 1
+        self.next_comment = 1
+        self.items = []
+        self.by_number = {}
+        for _ in range(size):
+            self.add_item()
+
+    def add_item(self):
+        number = self.next_number
+        self.next_number += 1
+        repo = self.repos[number % len(self.repos)]
+        item = {
+            "number": number,
+            "repo": repo,
+            "title": "Synthetic issue %s" % number,
+            "state": "OPEN",
+            "option": self.random.randrange(len(OPTIONS)),
+            "priority": self.random.randrange(len(PRIORITIES)),
+            "labels": ["tracked"] if self.random.random() < self.labelled else [],
+            # Only shown as a pull request on classic boards, the ProjectNext view keeps them as issues.
+            "pull": number % 10 == 0,
+            "comments": [],
+        }
+        self.items.append(item)
+        self.by_number[number] = item
+
+    def churn(self, fraction, comments=0, edits=0):
+        """Moves `fraction` of the items, adds and removes a quarter as many, and adds comments.
+
+        `edits` of the items get their title, state or priority changed instead.
+        """
+        count = int(len(self.items) * fraction)
+        for item in self.random.sample(self.items, min(count, len(self.items))):
+            item["option"] = (item["option"] + 1 + self.random.randrange(len(OPTIONS) - 1)) % len(OPTIONS)
+        for i, item in enumerate(self.random.sample(self.items, min(int(len(self.items) * edits), len(self.items)))):
+            if i % 3 == 0:
+                item["title"] += " (edited)"
+            elif i % 3 == 1:
+                item["state"] = "CLOSED" if item["state"] == "OPEN" else "OPEN"
+            else:
+                item["priority"] = (item["priority"] + 1) % len(PRIORITIES)
+        for _ in range(count // 4):
+            if self.items:
+                removed = self.items.pop(self.random.randrange(len(self.items)))
+                del self.by_number[removed["number"]]
+            self.add_item()
+        # Comments must land after the last_read written by the previous run.
+        created_at = (datetime.utcnow() + timedelta(seconds=2)).strftime(datetime_format)
+        for item in self.random.sample(self.items, min(comments, len(self.items))):
+            item["comments"].append(
+                {
+                    "id": self.next_comment,
+                    "body": "Synthetic **comment** %s" % self.next_comment,
+                    "login": "octocat",
+                    "created_at": created_at,
+                    "updated_at": created_at,
+                }
+            )
+            self.next_comment += 1
+
+
+class FakeGitHub:
+    """GraphQL, REST and Slack endpoints over one Board."""
+
+    def __init__(self, board, latency=0.0, latency_per_mb=0.0):
+        self.board = board
+        # Simulated server time per request, plus per MB of GraphQL response for the work behind big pages.
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        self.base_url = None
+        self.files = {}
+        # Commits of the default branch are only counted, the state branch is kept as git objects.
+        self.file_commits = 0
+        self.refs = {}
+        self.trees = {}
+        self.commits = {}
+        # Writes to these paths and refs fail, to exercise a run dying before its state is saved.
+        self.failing = set()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    # GraphQL objects
+
+    def issue_node(self, item):
+        html_url = "https://github.com/%s/issues/%s" % (item["repo"], item["number"])
+        return {
+            "__typename": "Issue",
+            "id": "I_%s" % item["number"],
+            "databaseId": item["number"],
+            "number": item["number"],
+            "title": item["title"],
+            "url": html_url,
+            "bodyUrl": html_url,
+            "state": item["state"],
+            "repository": {"name": item["repo"].split("/")[1], "nameWithOwner": item["repo"]},
+            "labels": {"nodes": [{"name": label} for label in item["labels"]]},
+            "comments": {"nodes": [self.comment_node(item, comment) for comment in item["comments"]]},
+            # Every item is on the bench board, projects/1.
+            "projectNextItems": lambda info, first=None: {"nodes": [{"id": "PNI_%s" % item["number"], "project": {"id": "PN_1"}}]},
+        }
+
+    def pull_node(self, item):
+        # A pull request's databaseId is its pull id, unlike the issue id the REST issues API returns.
+        return {
+            "__typename": "PullRequest",
+            "id": "PR_%s" % item["number"],
+            "databaseId": 1000000 + item["number"],
+            "number": item["number"],
+            "title": item["title"],
+            "url": "https://github.com/%s/pull/%s" % (item["repo"], item["number"]),
+            "state": "MERGED" if item["state"] == "CLOSED" else item["state"],
+            "repository": {"name": item["repo"].split("/")[1], "nameWithOwner": item["repo"]},
+            "labels": {"nodes": [{"name": label} for label in item["labels"]]},
+        }
+
+    def comment_node(self, item, comment):
+        return {
+            "id": "IC_%s" % comment["id"],
+            "databaseId": comment["id"],
+            "createdAt": comment["created_at"],
+            "updatedAt": comment["updated_at"],
+            "body": comment["body"],
+            "url": "https://github.com/%s/issues/%s#issuecomment-%s" % (item["repo"], item["number"], comment["id"]),
+            "author": {"login": comment["login"]},
+        }
+
+    def status_field(self):
+        options = [{"id": "option-%s" % i, "name": name} for i, name in enumerate(OPTIONS)]
+        return {"id": "F_status", "name": "Status", "settings": json.dumps({"options": options})}
+
+    def priority_field(self):
+        options = [{"id": "priority-%s" % i, "name": name} for i, name in enumerate(PRIORITIES)]
+        return {"id": "F_priority", "name": "Priority", "settings": json.dumps({"options": options})}
+
+    def item_node(self, item):
+        return {
+            "__typename": "ProjectNextItem",
+            "id": "PNI_%s" % item["number"],
+            "content": self.issue_node(item),
+            "fieldValues": {
+                "nodes": [
+                    {"projectField": {"id": "F_title"}, "value": item["title"]},
+                    {"projectField": {"id": "F_status"}, "value": "option-%s" % item["option"]},
+                    {"projectField": {"id": "F_priority"}, "value": "priority-%s" % item["priority"]},
+                ]
+            },
+        }
+
+    def project_next(self, info, number):
+        return {
+            "__typename": "ProjectNext",
+            "id": "PN_%s" % number,
+            "number": number,
+            "title": "Benchmark board",
+            "url": "https://github.com/orgs/bench/projects/%s" % number,
+            "owner": {"login": "bench", "name": "Bench"},
+            "fields": {
+                "nodes": [
+                    {"id": "F_title", "name": "Title", "settings": "null"},
+                    self.status_field(),
+                    self.priority_field(),
+                ]
+            },
+            "items": lambda info, first=None, after=None: paginate(self.board.items, first, after, self.item_node),
+        }
+
+    def column_node(self, index):
+        items = [item for item in self.board.items if item["option"] == index]
+        return {
+            "__typename": "ProjectColumn",
+            "id": "PC_%s" % index,
+            "databaseId": index + 1,
+            "name": OPTIONS[index],
+            "cards": lambda info, first=None, after=None, archivedStates=None: paginate(
+                items, first, after, lambda item: {"content": self.pull_node(item) if item["pull"] else self.issue_node(item)}
+            ),
+        }
+
+    def project(self, info, number):
+        return {
+            "__typename": "Project",
+            "id": "P_%s" % number,
+            "databaseId": number,
+            "number": number,
+            "name": "Benchmark board",
+            "url": "https://github.com/orgs/bench/projects/%s" % number,
+            "body": "A *synthetic* board.",
+            "columns": lambda info, first=None, after=None: paginate(
+                list(range(len(OPTIONS))), first, after, self.column_node
+            ),
+        }
+
+    def find_node(self, node_id):
+        kind, _, key = node_id.partition("_")
+        if kind == "PNI":
+            item = self.board.by_number.get(int(key))
+            return self.item_node(item) if item else None
+        if kind == "I":
+            item = self.board.by_number.get(int(key))
+            return self.issue_node(item) if item else None
+        if kind == "PC":
+            return self.column_node(int(key))
+        return None
+
+    def graphql(self, body):
+        request = json.loads(body)
+        root = {
+            "rateLimit": {"cost": 1, "remaining": 5000},
+            "organization": lambda info, login: {
+                "__typename": "Organization",
+                "id": "O_%s" % login,
+                "login": login,
+                "name": login.title(),
+                "projectNext": self.project_next,
+                "projectV2": lambda info, number: {"id": "PVT_%s" % number},
+                "project": self.project,
+            },
+            "node": lambda info, id: self.find_node(id),
+            "nodes": lambda info, ids: [self.find_node(x) for x in ids],
+        }
+        result = graphql_sync(SCHEMA, request["query"], root, variable_values=request.get("variables"))
+        response = {"data": result.data}
+        if result.errors:
+            response["errors"] = [{"message": str(e)} for e in result.errors]
+        return 200, response
+
+    # REST objects
+
+    def rest_issue(self, item):
+        url = "%s/repos/%s/issues/%s" % (self.base_url, item["repo"], item["number"])
+        return {
+            "id": item["number"],
+            "node_id": "I_%s" % item["number"],
+            "number": item["number"],
+            "title": item["title"],
+            "state": item["state"].lower(),
+            "url": url,
+            "html_url": "https://github.com/%s/%s/%s" % (item["repo"], "pull" if item["pull"] else "issues", item["number"]),
+            "repository_url": "%s/repos/%s" % (self.base_url, item["repo"]),
+            "comments_url": url + "/comments",
+            "labels": [{"name": label} for label in item["labels"]],
+            **({"pull_request": {"url": "%s/repos/%s/pulls/%s" % (self.base_url, item["repo"], item["number"])}} if item["pull"] else {}),
+        }
+
+    def rest_comment(self, item, comment):
+        return {
+            "id": comment["id"],
+            "node_id": "IC_%s" % comment["id"],
+            "body": comment["body"],
+            "user": {"login": comment["login"]},
+            "html_url": "https://github.com/%s/issues/%s#issuecomment-%s" % (item["repo"], item["number"], comment["id"]),
+            "issue_url": "%s/repos/%s/issues/%s" % (self.base_url, item["repo"], item["number"]),
+            "created_at": comment["created_at"],
+            "updated_at": comment["updated_at"],
+        }
+
+    def rest_column(self, index):
+        return {
+            "id": index + 1,
+            "name": OPTIONS[index],
+            "url": "%s/projects/columns/%s" % (self.base_url, index + 1),
+            "cards_url": "%s/projects/columns/%s/cards" % (self.base_url, index + 1),
+        }
+
+    def rest_page(self, path, query, records):
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["30"])[0])
+        start = (page - 1) * per_page
+        headers = {}
+        if start + per_page < len(records):
+            next_query = dict((k, v[0]) for k, v in query.items())
+            next_query.update(page=str(page + 1), per_page=str(per_page))
+            headers["Link"] = '<%s%s?%s>; rel="next"' % (self.base_url, path, urllib.parse.urlencode(next_query))
+        return 200, records[start:start + per_page], headers
+
+    def rest_file(self, path, content=None):
+        if content is None:
+            content, sha = self.files[path]
+        else:
+            sha = hashlib.sha1(content).hexdigest()
+        return {
+            "type": "file",
+            "encoding": "base64",
+            "name": path.split("/")[-1],
+            "path": path,
+            "sha": sha,
+            "size": len(content),
+            "content": base64.b64encode(content).decode("utf-8"),
+            "url": "%s/repos/bench/data/contents/%s" % (self.base_url, path),
+        }
+
+    def put_file(self, path, body):
+        if path in self.failing:
+            return 500, {"message": "Server Error"}
+        request = json.loads(body)
+        if path in self.files and request.get("sha") != self.files[path][1]:
+            return 409, {"message": "sha mismatch"}
+        content = base64.b64decode(request["content"])
+        self.files[path] = (content, hashlib.sha1(content).hexdigest())
+        self.file_commits += 1
+        return 200, {"content": self.rest_file(path), "commit": {"sha": hashlib.sha1(body).hexdigest()}}
+
+    def git_ref(self, ref):
+        return {
+            "ref": "refs/" + ref,
+            "url": "%s/repos/bench/data/git/refs/%s" % (self.base_url, ref),
+            "object": {"sha": self.refs[ref], "type": "commit", "url": "%s/repos/bench/data/git/commits/%s" % (self.base_url, self.refs[ref])},
+        }
+
+    def git_history(self, sha):
+        history = []
+        while sha is not None:
+            history.append(sha)
+            parents = self.commits[sha]["parents"]
+            sha = parents[0] if parents else None
+        return history
+
+    def git(self, method, kind, name, body):
+        request = json.loads(body) if body else {}
+        if kind in ("ref", "refs") and method == "GET":
+            if name not in self.refs:
+                return 404, {"message": "Not Found"}
+            return 200, self.git_ref(name)
+        if kind == "refs" and method == "POST":
+            name = request["ref"][len("refs/"):]
+            if name in self.refs:
+                return 422, {"message": "Reference already exists"}
+            self.refs[name] = request["sha"]
+            return 201, self.git_ref(name)
+        if kind == "refs" and method == "DELETE":
+            if name not in self.refs:
+                return 422, {"message": "Reference does not exist"}
+            del self.refs[name]
+            return 204, ""
+        if kind == "refs" and method == "PATCH":
+            if name in self.failing:
+                return 500, {"message": "Server Error"}
+            if not request.get("force") and self.refs[name] not in self.git_history(request["sha"]):
+                return 422, {"message": "Update is not a fast forward"}
+            self.refs[name] = request["sha"]
+            return 200, self.git_ref(name)
+        if kind == "trees" and method == "POST":
+            tree = dict(self.trees.get(request.get("base_tree"), {}))
+            tree.update((element["path"], element["content"].encode("utf-8")) for element in request["tree"])
+            sha = hashlib.sha1(body).hexdigest()
+            self.trees[sha] = tree
+            return 201, {"sha": sha, "url": "%s/repos/bench/data/git/trees/%s" % (self.base_url, sha), "tree": []}
+        if kind == "commits" and method == "POST":
+            sha = hashlib.sha1(body + str(len(self.commits)).encode("utf-8")).hexdigest()
+            self.commits[sha] = {"tree": request["tree"], "parents": request["parents"]}
+            return 201, {
+                "sha": sha,
+                "url": "%s/repos/bench/data/git/commits/%s" % (self.base_url, sha),
+                "message": request["message"],
+                "tree": {"sha": request["tree"], "url": "%s/repos/bench/data/git/trees/%s" % (self.base_url, request["tree"])},
+                "parents": [{"sha": parent} for parent in request["parents"]],
+            }
+        return 404, {"message": "Not Found"}
+
+    def data_commits(self):
+        """Commits reachable in the data repo, the history every clone and API call there has to deal with."""
+        return self.file_commits + sum(len(self.git_history(sha)) for sha in self.refs.values())
+
+    def rest(self, method, path, query, body):
+        parts = path.strip("/").split("/")
+        items = self.board.items
+        if parts[:3] == ["repos", "bench", "data"]:
+            if len(parts) == 3:
+                url = "%s/repos/bench/data" % self.base_url
+                return 200, {"id": 1, "name": "data", "full_name": "bench/data", "url": url}
+            if parts[3] == "git":
+                return self.git(method, parts[4], urllib.parse.unquote("/".join(parts[5:])), body)
+            file_path = urllib.parse.unquote("/".join(parts[4:]))
+            if method == "PUT":
+                return self.put_file(file_path, body)
+            if "ref" in query:
+                commit = self.commits.get(query["ref"][0])
+                if commit is None or file_path not in self.trees[commit["tree"]]:
+                    return 404, {"message": "Not Found"}
+                return 200, self.rest_file(file_path, self.trees[commit["tree"]][file_path])
+            if file_path not in self.files:
+                return 404, {"message": "Not Found"}
+            if method == "DELETE":
+                del self.files[file_path]
+                self.file_commits += 1
+                return 200, {"content": None, "commit": {"sha": hashlib.sha1(body).hexdigest()}}
+            return 200, self.rest_file(file_path)
+        if parts[0] == "projects" and parts[1] == "columns":
+            index = int(parts[2]) - 1
+            if len(parts) == 3:
+                return 200, self.rest_column(index)
+            cards = [
+                {
+                    "id": item["number"],
+                    "url": "%s/projects/columns/cards/%s" % (self.base_url, item["number"]),
+                    "content_url": "%s/repos/%s/issues/%s" % (self.base_url, item["repo"], item["number"]),
+                }
+                for item in items
+                if item["option"] == index
+            ]
+            return self.rest_page(path, query, cards)
+        if parts[0] == "projects" and len(parts) == 2:
+            url = "%s/projects/%s" % (self.base_url, parts[1])
+            return 200, {"id": int(parts[1]), "number": int(parts[1]), "url": url, "columns_url": url + "/columns"}
+        if parts[0] == "projects" and parts[2] == "columns":
+            return self.rest_page(path, query, [self.rest_column(i) for i in range(len(OPTIONS))])
+        if parts[0] == "repos" and parts[3] == "issues":
+            repo = "/".join(parts[1:3])
+            since = query.get("since", [""])[0]
+            if parts[4] == "comments":
+                records = [
+                    self.rest_comment(item, comment)
+                    for item in items
+                    if item["repo"] == repo
+                    for comment in item["comments"]
+                    if comment["updated_at"] >= since
+                ]
+                return self.rest_page(path, query, records)
+            item = self.board.by_number.get(int(parts[4]))
+            if item is None or item["repo"] != repo:
+                return 404, {"message": "Not Found"}
+            if len(parts) == 5:
+                return 200, self.rest_issue(item)
+            records = [self.rest_comment(item, c) for c in item["comments"] if c["updated_at"] >= since]
+            return self.rest_page(path, query, records)
+        return 404, {"message": "Not Found"}
+
+    def slack(self, path):
+        if path.endswith("/webhook"):
+            return 200, "ok"
+        return 200, {"ok": True, "channel": "C0BENCH", "ts": "%.6f" % time.time()}
+
+    # Bookkeeping
+
+    def phase(self, method, path, body):
+        if path.startswith("/slack/"):
+            return "notify"
+        if path == "/graphql":
+            query = json.loads(body)["query"]
+            if "comments" in query:
+                return "comments"
+            if "items(" in query or "columns(" in query or "cards(" in query:
+                return "crawl"
+            return "resolve"
+        if "/contents/" in path or "/git/" in path:
+            return "state_io"
+        if "comments" in path:
+            return "comments"
+        if path.startswith("/projects") or "/issues/" in path:
+            return "crawl"
+        return "resolve"
+
+    def record(self, entry):
+        with self.lock:
+            self.requests.append(entry)
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+
+
+def serve(fake):
+    """Starts the fake on a free local port, returns the server."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in separate writes, don't let Nagle delay the second one.
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def handle_request(self, method):
+            started = time.perf_counter()
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+            parsed = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(parsed.query)
+            headers = {}
+            if parsed.path.startswith("/slack/"):
+                status, response = fake.slack(parsed.path)
+            elif parsed.path == "/graphql":
+                status, response = fake.graphql(body)
+            else:
+                result = fake.rest(method, parsed.path, query, body)
+                status, response = result[0], result[1]
+                if len(result) == 3:
+                    headers = result[2]
+
+            data = response.encode("utf-8") if isinstance(response, str) else json.dumps(response).encode("utf-8")
+            if method == "GET" and status == 200 and not parsed.path.startswith("/slack/"):
+                # Validators like GitHub's, a matching If-None-Match gets an empty 304.
+                headers["ETag"] = '"%s"' % hashlib.sha1(data).hexdigest()
+                if self.headers.get("If-None-Match") == headers["ETag"]:
+                    status, data = 304, b""
+            delay = fake.latency
+            if parsed.path == "/graphql":
+                delay += fake.latency_per_mb * len(data) / 1e6
+            if delay:
+                time.sleep(delay)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+            fake.record(
+                {
+                    "phase": fake.phase(method, parsed.path, body),
+                    "method": method,
+                    "path": parsed.path,
+                    "status": status,
+                    "bytes_in": len(body),
+                    "bytes_out": len(data),
+                    "started": started,
+                    "finished": time.perf_counter(),
+                }
+            )
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def do_PUT(self):
+            self.handle_request("PUT")
+
+        def do_PATCH(self):
+            self.handle_request("PATCH")
+
+        def do_DELETE(self):
+            self.handle_request("DELETE")
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    fake.base_url = "http://127.0.0.1:%s" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakes import Board, FakeGitHub, serve
+
+# Offline end-to-end benchmark of the sync loop: runs a script once to seed
+# the state file, churns the synthetic board, then measures a second run and
+# a third one with nothing changed in between.
+#
+#   python bench/run.py --script next --sizes 100,1000,10000 --churn 0.05 --comments 20
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scripts = {
+    "next": os.path.join(root, "src", "project-next-state.py"),
+    "classic": os.path.join(root, "src", "project-state.py"),
+}
+phases = ["resolve", "crawl", "comments", "state_io", "notify"]
+
+
+def get_env(fake, args):
+    env = dict(os.environ)
+    env.update(
+        {
+            "LOCAL_DEV": "1",
+            "PAT": "bench",
+            "PROJECT_URL": "https://github.com/orgs/bench/projects/1",
+            "REPO_FOR_DATA": "bench/data",
+            "TRACK_ISSUES": "true" if args.comments else "false",
+            "SHOW_PROJECT_BODY": "false",
+            "GITHUB_API_URL": fake.base_url,
+            "GITHUB_GRAPHQL_URL": fake.base_url + "/graphql",
+            "SLACK_API_URL": fake.base_url + "/slack/api/",
+        }
+    )
+    if args.slack == "webhook":
+        env["SLACK_WEBHOOK"] = fake.base_url + "/slack/webhook"
+    else:
+        env.update({"SLACK_TOKEN": "bench", "SLACK_CHANNEL": "C0BENCH", "CHANNEL": "C0BENCH"})
+    if args.labels:
+        env["LABELS"] = args.labels
+    for pair in args.env:
+        key, _, value = pair.partition("=")
+        env[key] = value
+    return env
+
+
+def run_script(script, env, log):
+    env = dict(env, METRICS_FILE=log.name + ".metrics.json")
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script], env=env, stdout=log, stderr=subprocess.STDOUT)
+    # wait4 reports the rusage of this child alone.
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - started
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError("%s exited with %s, see %s" % (script, os.waitstatus_to_exitcode(status), log.name))
+    # ru_maxrss is in KiB on Linux
+    with open(env["METRICS_FILE"]) as f:
+        metrics = json.load(f)
+    return {"started": started, "wall": wall, "peak_rss_kb": usage.ru_maxrss, "metrics": metrics}
+
+
+def run_sharded(script, env, log, shards):
+    """Runs the plan, shard and reduce steps like a matrix workflow would, with the shards in parallel."""
+    env = dict(env, SHARDS=str(shards), SHARD_DIR=tempfile.mkdtemp(prefix="bench-shards-"))
+    # Like the documented workflow, only the reduce job gets the Slack configuration.
+    crawl_env = {k: v for k, v in env.items() if not k.startswith("SLACK_") and k != "CHANNEL"}
+    started = time.perf_counter()
+    planned = run_script(script, dict(crawl_env, MODE="plan"), log)
+    with open(os.path.join(env["SHARD_DIR"], "plan.json")) as f:
+        indexes = [shard["index"] for shard in json.load(f)["shards"]]
+    processes = [
+        subprocess.Popen(
+            [sys.executable, script],
+            env=dict(crawl_env, MODE="shard", SHARD_INDEX=str(index), METRICS_FILE=""),
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        for index in indexes
+    ]
+    peak_rss_kb = planned["peak_rss_kb"]
+    for process in processes:
+        _, status, usage = os.wait4(process.pid, 0)
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise RuntimeError("shard of %s exited with %s, see %s" % (script, os.waitstatus_to_exitcode(status), log.name))
+        peak_rss_kb = max(peak_rss_kb, usage.ru_maxrss)
+    reduced = run_script(script, dict(env, MODE="reduce"), log)
+    return {
+        "started": started,
+        "wall": time.perf_counter() - started,
+        "peak_rss_kb": max(peak_rss_kb, reduced["peak_rss_kb"]),
+        "metrics": reduced["metrics"],
+    }
+
+
+def summarize(fake, run):
+    requests = fake.requests
+    report = {
+        "wall": run["wall"],
+        "peak_rss_kb": run["peak_rss_kb"],
+        "startup": (min(r["started"] for r in requests) - run["started"]) if requests else None,
+        "phases": {},
+        "spans": run["metrics"]["spans"],
+        "counters": run["metrics"]["counters"],
+    }
+    for phase in phases:
+        matching = [r for r in requests if r["phase"] == phase]
+        if not matching:
+            continue
+        report["phases"][phase] = {
+            "requests": len(matching),
+            "bytes_in": sum(r["bytes_in"] for r in matching),
+            "bytes_out": sum(r["bytes_out"] for r in matching),
+            "span": max(r["finished"] for r in matching) - min(r["started"] for r in matching),
+        }
+    return report
+
+
+def print_report(size, report):
+    print("%s items: wall %.2fs, startup %.2fs, peak RSS %.1f MiB" % (
+        size, report["wall"], report["startup"] or 0, report["peak_rss_kb"] / 1024))
+    print("  %-10s %8s %12s %12s %9s" % ("phase", "requests", "bytes in", "bytes out", "span"))
+    for phase, stats in report["phases"].items():
+        print("  %-10s %8d %12d %12d %8.2fs" % (
+            phase, stats["requests"], stats["bytes_in"], stats["bytes_out"], stats["span"]))
+    # As measured by the script itself, see METRICS_FILE
+    print("  %-12s %6s %9s %10s" % ("span", "count", "seconds", "RSS MiB"))
+    for name, entry in report["spans"].items():
+        print("  %-12s %6d %8.2fs %10.1f" % (name, entry["count"], entry["seconds"], entry["max_rss_kb"] / 1024))
+    print("  " + ", ".join("%s=%s" % item for item in sorted(report["counters"].items())))
+    unchanged = report["unchanged"]
+    print("  data repo: %d commits" % report["data_commits"])
+    print("  unchanged rerun: wall %.2fs, startup %.2fs, peak RSS %.1f MiB, %d requests" % (
+        unchanged["wall"], unchanged["startup"] or 0, unchanged["peak_rss_kb"] / 1024,
+        sum(stats["requests"] for stats in unchanged["phases"].values())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--script", choices=scripts.keys(), default="next")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma-separated board sizes")
+    parser.add_argument("--churn", type=float, default=0.05, help="fraction of items moved between runs")
+    parser.add_argument("--edits", type=float, default=0, help="fraction of items with a title, state or priority change")
+    parser.add_argument("--comments", type=int, default=0, help="new comments between runs, enables TRACK_ISSUES")
+    parser.add_argument("--labels", default="", help="LABELS to filter comment tracking by")
+    parser.add_argument("--slack", choices=["api", "webhook"], default="api")
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the script")
+    parser.add_argument("--fail-save", action="store_true", help="let the state write of a first attempt fail, then measure the rerun")
+    parser.add_argument("--latency", type=float, default=0, help="simulated seconds per request")
+    parser.add_argument("--latency-per-mb", type=float, default=0, help="simulated seconds per MB of GraphQL response")
+    parser.add_argument("--shards", type=int, default=0, help="run as plan, parallel shards and reduce")
+    parser.add_argument("--json", help="write the reports to this file")
+    parser.add_argument("--log", default="bench_output.txt", help="script output")
+    args = parser.parse_args()
+
+    reports = {}
+    with open(args.log, "w") as log:
+        for size in [int(x) for x in args.sizes.split(",")]:
+            fake = FakeGitHub(Board(size), args.latency, args.latency_per_mb)
+            server = serve(fake)
+            env = get_env(fake, args)
+            if args.shards:
+                run = lambda: run_sharded(scripts[args.script], env, log, args.shards)
+            else:
+                run = lambda: run_script(scripts[args.script], env, log)
+            try:
+                run()
+                fake.board.churn(args.churn, args.comments, args.edits)
+                if args.fail_save:
+                    fake.failing = set(fake.files) | set(fake.refs)
+                    try:
+                        run()
+                    except RuntimeError:
+                        pass
+                    fake.failing = set()
+                fake.reset()
+                report = summarize(fake, run())
+                # Nothing changed since, the common case for a scheduled run.
+                fake.reset()
+                report["unchanged"] = summarize(fake, run())
+                report["data_commits"] = fake.data_commits()
+            finally:
+                server.shutdown()
+            print_report(size, report)
+            reports[size] = report
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,33 @@
 from datetime import datetime, timedelta
 from github import Github, GithubException, RateLimitExceededException, Issue, Organization
-from htmlslacker import HTMLSlacker
-from slack import WebClient
-from slack.errors import SlackApiError
+from github.GitCommit import GitCommit
+from github.InputGitTreeElement import InputGitTreeElement
 from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.requests import RequestsHTTPTransport
+import base64
 import codecs
+import contextlib
+import cProfile
+import functools
+import hashlib
+import hmac
+import http.server
 import json
-import markdown
 import os
+import pstats
 import re
 import requests
+import resource
 import sys
+import threading
 import time
+import tracemalloc
 import urllib
 
 datetime_format = "%Y-%m-%dT%H:%M:%SZ"
+# Set by GitHub Actions, overridable to run against a local stand-in (see bench/).
+api_url = os.getenv("GITHUB_API_URL", "https://api.github.com")
+graphql_url = os.getenv("GITHUB_GRAPHQL_URL", api_url + "/graphql")
 
 
 def escape_slack_link(original):
@@ -28,34 +40,279 @@ def get_now():
     current_time = now.strftime(datetime_format)
     return current_time
 
-def fetch_project_fields(project_dict):
-    query = gql(
-        f"""
-        query {{
-            organization(login: "{project_dict['owner']['name']}") {{
-                projectNext(number: {project_dict['number']}) {{
-                    fields(first: 25) {{
-                        nodes {{
+
+def get_env_var_name(name):
+    if "LOCAL_DEV" in os.environ:
+        return name
+    else:
+        return "INPUT_%s" % name
+
+
+def get_env_var(name):
+    return os.getenv(get_env_var_name(name))
+
+def is_env_var_present(name):
+    return get_env_var_name(name) in os.environ and get_env_var(name) != ""
+
+
+metrics = {"spans": {}, "counters": {}}
+metrics_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = metrics["spans"].setdefault(name, {"count": 0, "seconds": 0.0, "max_rss_kb": 0})
+        entry["count"] += 1
+        entry["seconds"] += time.perf_counter() - started
+        # ru_maxrss is the high-water mark so far, in KiB on Linux
+        entry["max_rss_kb"] = max(entry["max_rss_kb"], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def count(name, value=1):
+    with metrics_lock:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + value
+
+
+def instrument_requests():
+    # PyGithub and the Slack webhook both go through requests, count their calls at the transport.
+    send = requests.Session.send
+
+    def counted_send(self, request, **kwargs):
+        response = send(self, request, **kwargs)
+        if request.url == graphql_url:
+            # Counted by run_query
+            return response
+        kind = "rest" if request.url.startswith(api_url) else "webhook"
+        count(f"{kind}_calls")
+        count(f"{kind}_bytes", len(response.content))
+        return response
+
+    requests.Session.send = counted_send
+
+
+http_cache_dir = get_env_var("HTTP_CACHE_DIR")
+
+
+def get_http_cache_path(request):
+    # ETags differ per token, which only goes into the key hashed.
+    key = "\n".join([request.url, request.headers.get("Accept", ""), request.headers.get("Authorization", "")])
+    return os.path.join(http_cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def get_cached_response(request, response, entry):
+    cached = requests.Response()
+    cached.status_code = 200
+    cached.reason = "OK"
+    cached.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+    # Keeps the rate limit headers of the 304 current.
+    cached.headers.update(response.headers)
+    cached._content = base64.b64decode(entry["body"])
+    cached.encoding = requests.utils.get_encoding_from_headers(cached.headers)
+    cached.url = request.url
+    cached.request = request
+    cached.connection = response.connection
+    cached.elapsed = response.elapsed
+    return cached
+
+
+def install_http_cache():
+    """Revalidates REST GETs against the responses kept in HTTP_CACHE_DIR, GitHub doesn't count 304s against the rate limit."""
+    os.makedirs(http_cache_dir, exist_ok=True)
+    send = requests.Session.send
+
+    def cached_send(self, request, **kwargs):
+        if request.method != "GET" or not request.url.startswith(api_url):
+            return send(self, request, **kwargs)
+        path = get_http_cache_path(request)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None:
+            if entry["etag"]:
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+        response = send(self, request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            count("http_cache_hits")
+            # Recency for the LRU eviction in prune_http_cache
+            os.utime(path)
+            return get_cached_response(request, response, entry)
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            headers = {k: v for k, v in response.headers.items()
+                       if k.lower() not in ("content-length", "content-encoding", "transfer-encoding")}
+            entry = {
+                "url": request.url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "headers": headers,
+                "body": base64.b64encode(response.content).decode("ascii"),
+            }
+            # Written aside and renamed, so other threads never read half an entry.
+            temp = "%s.%s.tmp" % (path, threading.get_ident())
+            with open(temp, "w") as f:
+                json.dump(entry, f)
+            os.replace(temp, path)
+        return response
+
+    requests.Session.send = cached_send
+
+
+def prune_http_cache():
+    """Evicts the least recently used responses once HTTP_CACHE_DIR outgrows HTTP_CACHE_MAX_MB."""
+    limit = float(get_env_var("HTTP_CACHE_MAX_MB") or 50) * 1024 * 1024
+    entries = []
+    for name in os.listdir(http_cache_dir):
+        stat = os.stat(os.path.join(http_cache_dir, name))
+        entries.append((stat.st_mtime, stat.st_size, os.path.join(http_cache_dir, name)))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        os.remove(path)
+        total -= size
+        count("http_cache_evictions")
+
+
+def run_query(query):
+    result = gql_client.execute(query)
+    count("graphql_queries")
+    count("graphql_bytes", len(json.dumps(result)))
+    count("graphql_cost", result.get("rateLimit", {}).get("cost", 0))
+    return result
+
+
+profile_dir = get_env_var("PROFILE_DIR")
+profiles = {}
+profile_lock = threading.Lock()
+if profile_dir:
+    tracemalloc.start()
+
+
+def profiled(stage):
+    # Unless PROFILE_DIR is set the function is handed back untouched, so normal runs pay nothing.
+    def decorate(fn):
+        if not profile_dir:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # Only one profiler can be active, nested and concurrent calls count towards the outer stage.
+            if not profile_lock.acquire(blocking=False):
+                return fn(*args, **kwargs)
+            try:
+                profile = profiles.setdefault(
+                    stage, {"cpu": cProfile.Profile(), "calls": 0, "peak": 0, "allocations": {}})
+                before = tracemalloc.take_snapshot()
+                tracemalloc.reset_peak()
+                profile["cpu"].enable()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    profile["cpu"].disable()
+                    profile["calls"] += 1
+                    profile["peak"] = max(profile["peak"], tracemalloc.get_traced_memory()[1])
+                    for stat in tracemalloc.take_snapshot().compare_to(before, "lineno"):
+                        site = str(stat.traceback)
+                        size, blocks = profile["allocations"].get(site, (0, 0))
+                        profile["allocations"][site] = (size + stat.size_diff, blocks + stat.count_diff)
+            finally:
+                profile_lock.release()
+
+        return wrapper
+
+    return decorate
+
+
+def write_profiles():
+    if not profile_dir:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    for stage, profile in profiles.items():
+        path = os.path.join(profile_dir, stage)
+        # Open with `python -m pstats` or snakeviz
+        profile["cpu"].dump_stats(path + ".prof")
+        with open(path + ".txt", "w") as f:
+            pstats.Stats(profile["cpu"], stream=f).sort_stats("cumulative").print_stats(40)
+        with open(path + ".alloc.txt", "w") as f:
+            f.write("%s: %d calls, peak traced memory %.1f KiB\n\n" % (stage, profile["calls"], profile["peak"] / 1024))
+            f.write("%12s %10s  %s\n" % ("KiB", "blocks", "allocation site"))
+            top = sorted(profile["allocations"].items(), key=lambda item: abs(item[1][0]), reverse=True)[:25]
+            for site, (size, blocks) in top:
+                f.write("%12.1f %10d  %s\n" % (size / 1024, blocks, site))
+    print(f"Wrote profiles for {', '.join(profiles)} to {profile_dir}")
+
+
+def write_metrics(project_dict):
+    labels = 'project="%s"' % project_dict.get("id", "")
+    filename = get_env_var("METRICS_FILE")
+    if filename:
+        if filename.endswith(".prom") or filename.endswith(".txt"):
+            lines = ["# TYPE project_sync_phase_seconds counter"]
+            for name, entry in metrics["spans"].items():
+                lines.append('project_sync_phase_seconds_total{%s,phase="%s"} %f' % (labels, name, entry["seconds"]))
+            lines.append("# TYPE project_sync_phase counter")
+            for name, entry in metrics["spans"].items():
+                lines.append('project_sync_phase_total{%s,phase="%s"} %d' % (labels, name, entry["count"]))
+            for name, value in metrics["counters"].items():
+                lines.append("# TYPE project_sync_%s counter" % name)
+                lines.append("project_sync_%s_total{%s} %d" % (name, labels, value))
+            lines.append("# EOF")
+            output = "\n".join(lines) + "\n"
+        else:
+            output = json.dumps({"project": project_dict.get("id"), "time": get_now(), **metrics}, indent=2)
+        with open(filename, "w") as f:
+            f.write(output)
+
+    summary = os.getenv("GITHUB_STEP_SUMMARY")
+    if summary:
+        with open(summary, "a") as f:
+            f.write("### Project sync for %s\n\n" % project_dict.get("title", project_dict.get("id", "")))
+            f.write("| Phase | Count | Seconds | Peak RSS (MiB) |\n| --- | ---: | ---: | ---: |\n")
+            for name, entry in metrics["spans"].items():
+                f.write("| %s | %d | %.2f | %.1f |\n" % (name, entry["count"], entry["seconds"], entry["max_rss_kb"] / 1024))
+            f.write("\n| Counter | Value |\n| --- | ---: |\n")
+            for name, value in metrics["counters"].items():
+                f.write("| %s | %d |\n" % (name, value))
+            f.write("\n")
+
+
+# The first page also carries the project identity and field settings,
+# so a run doesn't spend separate queries resolving them.
+project_header = """
+                    id
+                    title
+                    url
+                    fields(first: 25) {
+                        nodes {
                             name
                             settings
                             id
-                        }}
-                    }}
-                }}
-            }}
-        }}
-    """
-    )
-    result = gql_client.execute(query)
-    return result["organization"]["projectNext"]["fields"]["nodes"]
+                        }
+                    }
+"""
+
 
 def fetch_project_items_page(project_dict, cursor, page_size):
     after = f"after: \"{cursor}\", " if isinstance(cursor, str) else ""
+    header = "" if isinstance(cursor, str) else project_header
+    # Label names let comment tracking skip unlabelled issues without downloading their comments.
+    labels_selection = "labels(first: 100) { nodes { name } }" if labels else ""
     query = gql(
         f"""
         query {{
-            organization(login: "{project_dict['owner']['name']}") {{
+            rateLimit {{
+                cost
+            }}
+            organization(login: "{project_dict['owner']['login']}") {{
                 projectNext(number: {project_dict['number']}) {{
+                    {header}
                     items({after}first: {page_size}) {{
                         edges {{
                             cursor
@@ -68,6 +325,7 @@ def fetch_project_items_page(project_dict, cursor, page_size):
                                         url
                                         bodyUrl
                                         state
+                                        {labels_selection}
                                     }}
                                 }}
                                 fieldValues(first: 25) {{
@@ -86,19 +344,114 @@ def fetch_project_items_page(project_dict, cursor, page_size):
         }}
     """
     )
-    result = gql_client.execute(query)
-    return result["organization"]["projectNext"]["items"]["edges"]
+    result = run_query(query)
+    return result["organization"]["projectNext"]
 
-def get_state(project_dict):
-    stored = {}
+def fetch_project_item(item_id):
+    query = gql(
+        f"""
+        query {{
+            rateLimit {{
+                cost
+            }}
+            node(id: "{item_id}") {{
+                ... on ProjectNextItem {{
+                    content {{
+                        ... on Issue {{
+                            id
+                            number
+                            title
+                            url
+                            bodyUrl
+                            state
+                        }}
+                    }}
+                    fieldValues(first: 25) {{
+                        nodes {{
+                            projectField {{
+                                id
+                            }}
+                            value
+                        }}
+                    }}
+                }}
+            }}
+        }}
+    """
+    )
+    result = run_query(query)
+    return result["node"]
+
+def fetch_project_v2_id(project_dict):
+    query = gql(
+        f"""
+        query {{
+            rateLimit {{
+                cost
+            }}
+            organization(login: "{project_dict['owner']['login']}") {{
+                projectV2(number: {project_dict['number']}) {{
+                    id
+                }}
+            }}
+        }}
+    """
+    )
+    result = run_query(query)
+    return result["organization"]["projectV2"]["id"]
+
+
+def find_project_item(project_dict, content_id):
+    """Finds the ProjectNext item of an issue, for Projects v2 deliveries whose item ids the ProjectNext API doesn't know."""
+    return find_project_items(project_dict, [content_id]).get(content_id)
 
-    if is_env_var_present("PROJECT_PIVOT_FIELD"):
-        pivot_field_name = get_env_var("PROJECT_PIVOT_FIELD")
-    else:
-        pivot_field_name = "Status"
 
-    fields = fetch_project_fields(project_dict)
+def find_project_items(project_dict, content_ids):
+    """Maps the issues that are on the board to their ProjectNext items, leaving out the others."""
+    items = {}
+    page_size = 100
+    for start in range(0, len(content_ids), page_size):
+        ids = ", ".join(f'"{x}"' for x in content_ids[start:start + page_size])
+        query = gql(
+            f"""
+            query {{
+                rateLimit {{
+                    cost
+                }}
+                nodes(ids: [{ids}]) {{
+                    ... on Issue {{
+                        id
+                        projectNextItems(first: 100) {{
+                            nodes {{
+                                id
+                                project {{
+                                    id
+                                }}
+                            }}
+                        }}
+                    }}
+                }}
+            }}
+        """
+        )
+        result = run_query(query)
+        for node in result["nodes"]:
+            for item in ((node or {}).get("projectNextItems") or {"nodes": []})["nodes"]:
+                if item["project"]["id"] == project_dict["id"]:
+                    items[node["id"]] = item["id"]
+    return items
+
+
+def get_pivot_fields(fields):
     # Assume 'Status' field as pivot field.
+    names = ["Status"]
+    if is_env_var_present("PROJECT_PIVOT_FIELD"):
+        names = [x.strip() for x in get_env_var("PROJECT_PIVOT_FIELD").split(",") if x.strip()]
+    # The first field lays out the snapshot's columns, the others are stored per item.
+    return [get_pivot_field(fields, name) for name in names]
+
+
+def get_pivot_field(fields, pivot_field_name):
     pivot_field = next((x for x in fields if x["name"] == pivot_field_name), None)
     if pivot_field is None:
         raise ValueError(f"Project does not contain field: `{pivot_field_name}`. Unable to pivot.")
@@ -113,54 +466,170 @@ def get_state(project_dict):
         raise ValueError(f"Project field `{pivot_field_name}` is not a Single Select type. Unable to pivot.")
 
     print(f" field options '{list(map(lambda x: x['name'], pivot_field_options))}'")
-    for option in pivot_field_options:
-        stored[option['id']] = {
+    return {
+        "id": pivot_field["id"],
+        "name": pivot_field["name"],
+        "options": pivot_field_options,
+        "digest": hashlib.sha1(json.dumps(pivot_field_options, sort_keys=True).encode("utf-8")).hexdigest(),
+    }
+
+
+def get_item_option(node, pivot_field):
+    field_values = node["fieldValues"]["nodes"]
+    pivot_field_value = next((x for x in field_values if x["projectField"]["id"] == pivot_field["id"]), None)
+    if pivot_field_value is None:
+        return "no-option-placeholder"
+    return pivot_field_value["value"]
+
+
+def get_item(node, project_dict):
+    """Returns the pivot option and the record of an item."""
+    record = get_item_record(node["content"])
+    if len(project_dict["pivot_fields"]) > 1:
+        record["pivots"] = {x["id"]: get_item_option(node, x) for x in project_dict["pivot_fields"][1:]}
+    record = track_item_fields(record, node, project_dict["tracked_fields"])
+    return get_item_option(node, project_dict["pivot_field"]), record
+
+
+def get_item_record(content):
+    return {
+        "id": content["id"],
+        "number": content["number"],
+        "url": content["url"],
+        "html_url": content["bodyUrl"],
+        "title": content["title"],
+        "state": content["state"],
+    }
+
+
+def get_tracked_fields(fields):
+    # `title` and `state` are attributes of the issue, any other name is a project field.
+    names = [x.strip() for x in (get_env_var("TRACKED_FIELDS") or "").split(",") if x.strip()]
+    tracked_fields = []
+    for name in names:
+        if name in ("title", "state"):
+            tracked_fields.append({"id": None, "name": name, "options": {}})
+            continue
+        field = next((x for x in fields if x["name"] == name), None)
+        if field is None:
+            raise ValueError(f"Project does not contain field: `{name}`. Unable to track it.")
+        # Single select and iteration values are ids, keep their names to show in notifications.
+        settings = json.loads(field["settings"]) or {}
+        configuration = settings.get("configuration") or {}
+        options = {x["id"]: x["name"] for x in settings.get("options") or []}
+        for iteration in configuration.get("iterations", []) + configuration.get("completed_iterations", []):
+            options[iteration["id"]] = iteration["title"]
+        tracked_fields.append({"id": field["id"], "name": name, "options": options})
+    if tracked_fields:
+        print(f"Tracking changes of {', '.join(x['name'] for x in tracked_fields)}")
+    return tracked_fields
+
+
+def track_item_fields(record, node, tracked_fields):
+    if not tracked_fields:
+        return record
+    field_values = {x["projectField"]["id"]: x["value"] for x in node["fieldValues"]["nodes"]}
+    record["fields"] = {}
+    for field in tracked_fields:
+        if field["id"] is not None:
+            value = field_values.get(field["id"])
+            record["fields"][field["name"]] = field["options"].get(value, value)
+    record["digest"] = get_item_digest(record, tracked_fields)
+    return record
+
+
+def get_tracked_value(record, field):
+    if field["id"] is None:
+        return record.get(field["name"])
+    return record.get("fields", {}).get(field["name"])
+
+
+def get_item_digest(record, tracked_fields):
+    # Only ever compared with the same item's previous digest, a short one is plenty.
+    values = [get_tracked_value(record, field) for field in tracked_fields]
+    return hashlib.sha1(json.dumps(values).encode("utf-8")).hexdigest()[:16]
+
+
+def set_project(project_dict, page):
+    if page is None:
+        raise ValueError("Couldn't resolve project with URL %s" % (get_env_var("PROJECT_URL")))
+    project_dict["id"] = page["id"]
+    project_dict["title"] = page["title"]
+    project_dict["url"] = page["url"]
+    project_dict["pivot_fields"] = get_pivot_fields(page["fields"]["nodes"])
+    project_dict["pivot_field"] = project_dict["pivot_fields"][0]
+    project_dict["tracked_fields"] = get_tracked_fields(page["fields"]["nodes"])
+
+
+def get_columns(pivot_field):
+    columns = {}
+    for option in pivot_field["options"]:
+        columns[option['id']] = {
             "id": option['id'],
             "name": option['name'],
             "issues": {},
         }
-    stored["no-option-placeholder"] = {
+    columns["no-option-placeholder"] = {
         "id": "no-option-placeholder",
         "name": f"No {pivot_field['name']}",
         "issues": {},
     }
+    return columns
 
-    cursor = None
+
+def iter_state_pages(project_dict, stored, cursor=None, pages=None):
+    # The first page of the board also resolves the project and sets up the columns in stored.
+    # A shard starts at a planned cursor instead, with the project resolved by the planner.
+    if cursor is not None:
+        stored.update(get_columns(project_dict["pivot_field"]))
+    if cursor is None:
+        # A full crawl, e.g. a reconciliation in server mode, starts over so issues that lost their label drop out.
+        project_dict["labelled_items"] = set()
+    else:
+        project_dict.setdefault("labelled_items", set())
     page_size = 100
+    fetched = 0
     while True: # fetch all pages
         print(f"Fetching page after cursor: {cursor}")
-        items = fetch_project_items_page(project_dict, cursor, page_size)
+        with span("crawl_page"):
+            page = fetch_project_items_page(project_dict, cursor, page_size)
+        if cursor is None:
+            set_project(project_dict, page)
+            stored.update(get_columns(project_dict["pivot_field"]))
+
+        items = page["items"]["edges"]
+        records = []
         for item in items:
             content = item["node"]["content"]
             if content is None or bool(content) is False:
                 # Draft Issue or Pull Request
                 continue
 
-            field_values = item["node"]["fieldValues"]["nodes"]
-            pivot_field_value = next((x for x in field_values if x["projectField"]["id"] == pivot_field["id"]), None)
-            if pivot_field_value is None:
-                assigned_pivot_field_option = "no-option-placeholder"
-            else:
-                assigned_pivot_field_option = pivot_field_value["value"]
-
-            item_record = {
-                "id": content["id"],
-                "number": content["number"],
-                "url": content["url"],
-                "html_url": content["bodyUrl"],
-                "title": content["title"],
-                "state": content["state"],
-            }
-            stored[assigned_pivot_field_option]["issues"][content["id"]] = item_record
+            records.append(get_item(item["node"], project_dict))
+            if labels and filter_labels([x["name"] for x in content["labels"]["nodes"]], labels):
+                project_dict["labelled_items"].add(content["id"])
 
         items_count = len(items)
+        fetched += 1
+        count("items", items_count)
         print(f" Items count: {items_count}")
+        yield records
         if items_count == 0 or items_count < page_size:
             print(" Stop: Last page fetched")
             break
+        if pages is not None and fetched >= pages:
+            print(f" Stop: {pages} pages fetched")
+            break
 
         cursor = items[-1]["cursor"]
 
+
+@profiled("get_state")
+def get_state(project_dict):
+    stored = {}
+    for records in iter_state_pages(project_dict, stored):
+        for option, record in records:
+            stored[option]["issues"][record["id"]] = record
     return stored
 
 
@@ -173,7 +642,7 @@ def filter_labels(issue_labels: list, labels: list):
                 return True
         return False
 
-def resolve_url(gql_client, url):
+def resolve_url(url):
     parsed = urllib.parse.urlparse(url)
     assert parsed.scheme == 'https', "Must be a HTTPS URL"
     assert parsed.netloc == 'github.com', "Must be on github.com"
@@ -182,37 +651,21 @@ def resolve_url(gql_client, url):
     project_number = split[-1]
     project_org = split[-3]
 
-    query = gql(
-        f"""
-        query {{
-            organization(login: "{project_org}") {{
-                projectNext(number: {project_number}) {{
-                    owner {{
-                        ... on Organization {{
-                            name
-                        }}
-                    }}
-                    id
-                    number
-                    title
-                    url
-                }}
-            }}
-        }}
-    """
-    )
-    result = gql_client.execute(query)
-    print(result)
-    if result["organization"]["projectNext"] is None:
-        ValueError("Couldn't resolve project with URL %s" % (url))
-    return result["organization"]["projectNext"]
+    # id, title, url and the pivot field are filled in from the first page of items, see get_state.
+    return {
+        "owner": {"login": project_org},
+        "number": int(project_number),
+    }
 
 def fetch_project_items_with_comments_page(project_dict, cursor, page_size):
     after = f"after: \"{cursor}\", " if isinstance(cursor, str) else ""
     query = gql(
         f"""
         query {{
-            organization(login: "{project_dict['owner']['name']}") {{
+            rateLimit {{
+                cost
+            }}
+            organization(login: "{project_dict['owner']['login']}") {{
                 projectNext(number: {project_dict['number']}) {{
                     items({after}first: {page_size}) {{
                         edges {{
@@ -224,12 +677,6 @@ def fetch_project_items_with_comments_page(project_dict, cursor, page_size):
                                         title
                                         bodyUrl
 
-                                        labels(first: 100) {{
-                                            nodes {{
-                                                name
-                                            }}
-                                        }}
-
                                         comments(first: 100) {{
                                             nodes {{
                                                 id
@@ -252,24 +699,115 @@ def fetch_project_items_with_comments_page(project_dict, cursor, page_size):
         }}
     """
     )
-    result = gql_client.execute(query)
+    result = run_query(query)
     return result["organization"]["projectNext"]["items"]["edges"]
 
 
-def get_comments(project_dict, last_state):
-    if last_state is None:
-        print("last_state is none, skipping")
-        return {}
+def fetch_issues_with_comments(issue_ids):
+    ids = ", ".join(f'"{x}"' for x in issue_ids)
+    query = gql(
+        f"""
+        query {{
+            rateLimit {{
+                cost
+            }}
+            nodes(ids: [{ids}]) {{
+                ... on Issue {{
+                    id
+                    title
+                    bodyUrl
+
+                    comments(first: 100) {{
+                        nodes {{
+                            id
+                            createdAt
+                            updatedAt
+                            body
+                            url
+                            author {{
+                                login
+                            }}
+                        }}
+                    }}
+                }}
+            }}
+        }}
+    """
+    )
+    result = run_query(query)
+    return result["nodes"]
+
+
+def get_issue_comments(content, issue_last_read):
+    content_id = content["id"]
+    comments = []
+    comments_update = []
+    if content_id in issue_last_read.keys():
+        since = datetime.strptime(issue_last_read[content_id], datetime_format)
+        print(f"looking for comments since {since}")
+
+        for comment in content["comments"]["nodes"]:
+            created_at = datetime.strptime(comment["createdAt"], datetime_format)
+            if created_at > since:
+                print(f" found new comment {comment['url']} created at: {comment['createdAt']}, updated at: {comment['updatedAt']}")
+                count("comments_new")
+                comments.append(comment)
+            else:
+                updated_at = datetime.strptime(comment["updatedAt"], datetime_format)
+                if updated_at > since:
+                    print(f" found updated comment {comment['url']} created at: {comment['createdAt']}, updated at: {comment['updatedAt']}")
+                    count("comments_updated")
+                    comments_update.append(comment)
+                else:
+                    print(f" skipping old comment {comment['url']} created at: {comment['createdAt']}, updated at: {comment['updatedAt']}")
+    else:
+        print(f" skipping all previous comments for {content['bodyUrl']} (no last_read marked)")
+
+    return {
+        "issue_id": content_id,
+        "issue_html_url": content["bodyUrl"],
+        "issue_title": content["title"],
+        "comments": comments,
+        "comments_update": comments_update,
+    }
+
+
+def get_issue_last_read(state):
     issue_last_read = {}
-    for column in last_state.values():
+    for column in state.values():
         for k in column["issues"].values():
             if "last_read" in k.keys():
                 issue_last_read[k["id"]] = k["last_read"]
+    return issue_last_read
+
+
+def get_comments_by_ids(issue_ids, issue_last_read):
+    issue_comments = {}
+    page_size = 25
+    for start in range(0, len(issue_ids), page_size):
+        for content in fetch_issues_with_comments(issue_ids[start:start + page_size]):
+            if content:
+                issue_comments[content["id"]] = get_issue_comments(content, issue_last_read)
+    return issue_comments
+
+
+@profiled("get_comments")
+def get_comments(project_dict, last_state):
+    if last_state is None:
+        print("last_state is none, skipping")
+        return {}
+    issue_last_read = get_issue_last_read(last_state)
+
+    if labels:
+        # The crawl already found the labelled issues, only their comments are fetched.
+        issue_ids = sorted(x for x in project_dict["labelled_items"] if x in issue_last_read)
+        print(f" Fetching comments for {len(issue_ids)} of {len(project_dict['labelled_items'])} labelled issues")
+        return get_comments_by_ids(issue_ids, issue_last_read)
 
     print(f" Fetching comments for project items")
+    issue_comments = {}
     cursor = None
     page_size = 10
-    issue_comments = {}
     while True:  # fetch all pages
         items = fetch_project_items_with_comments_page(project_dict, cursor, page_size)
         for item in items:
@@ -279,42 +817,7 @@ def get_comments(project_dict, last_state):
                 continue
 
             print("issue %s found" % content["bodyUrl"])
-
-            content_labels = list(map(lambda x: x['name'], content["labels"]["nodes"]))
-
-            if not filter_labels(content_labels, labels):
-                print(f"skipping issue {content['bodyUrl']} (no matching label)")
-                continue
-
-            content_id = content["id"]
-            comments = []
-            comments_update = []
-            if content_id in issue_last_read.keys():
-                since = datetime.strptime(issue_last_read[content_id], datetime_format)
-                print(f"looking for comments since {since}")
-
-                for comment in content["comments"]["nodes"]:
-                    created_at = datetime.strptime(comment["createdAt"], datetime_format)
-                    if created_at > since:
-                        print(f" found new comment {comment['url']} created at: {comment['createdAt']}, updated at: {comment['updatedAt']}")
-                        comments.append(comment)
-                    else:
-                        updated_at = datetime.strptime(comment["updatedAt"], datetime_format)
-                        if updated_at > since:
-                            print(f" found updated comment {comment['url']} created at: {comment['createdAt']}, updated at: {comment['updatedAt']}")
-                            comments_update.append(comment)
-                        else:
-                            print(f" skipping old comment {comment['url']} created at: {comment['createdAt']}, updated at: {comment['updatedAt']}")
-            else:
-                print(f" skipping all previous comments for {content['bodyUrl']} (no last_read marked)")
-
-            issue_comments[content_id] = {
-                "issue_id": content_id,
-                "issue_html_url": content["bodyUrl"],
-                "issue_title": content["title"],
-                "comments": comments,
-                "comments_update": comments_update,
-            }
+            issue_comments[content["id"]] = get_issue_comments(content, issue_last_read)
 
         items_count = len(items)
         print(f" Items count: {items_count}")
@@ -327,69 +830,335 @@ def get_comments(project_dict, last_state):
     return issue_comments
 
 
-def save_data(repo, project_dict, state):
-    for column in state:
-        for issue in state[column]["issues"]:
-            state[column]["issues"][issue]["last_read"] = get_now()
+def save_data(repo, project_dict, state, mark_read=True):
+    if mark_read:
+        for column in state:
+            for issue in state[column]["issues"]:
+                state[column]["issues"][issue]["last_read"] = get_now()
 
     filename = ".data/%s.json" % project_dict['id']
+    if get_env_var("STATE_BRANCH"):
+        save_branch_data(repo, project_dict, state, filename)
+        clear_checkpoint(repo, project_dict)
+        return
+    # Known from get_data, the file is only fetched again after a conflict.
+    sha = project_dict.get("data_sha")
     i = 1
     while True:
         try:
-            content = repo.get_contents(filename)
+            if sha is None:
+                sha = repo.get_contents(filename).sha
             # TODO this will probably fail on unicode.
-            return repo.update_file(content.path, "Update", json.dumps(state), content.sha)
+            result = repo.update_file(filename, "Update", json.dumps({**state, "_meta": get_meta(project_dict)}), sha)
+            project_dict["data_sha"] = result["content"].sha
+            break
         except GithubException as e:
             if e.status == 409: # 409 (Conflict) when other runs update at the same time
+                sha = None
                 if (i <= 3):
                     print("Received 409 when pushing updates. Sleeping for %s seconds before retry %s" % (i * 5, i))
                     time.sleep(i * 5)
                     i += 1
                     continue
                 else:
-                    raise "Failed to update data content"
+                    raise Exception("Failed to update data content")
             else:
                 raise
+    # The snapshot now has everything the checkpoint had.
+    clear_checkpoint(repo, project_dict)
+    return result
 
 
-def init_data(repo, project_dict):
+def get_state_history():
+    return int(get_env_var("STATE_HISTORY") or 1)
+
+
+def get_state_ref(project_dict):
+    return "heads/%s/%s" % (get_env_var("STATE_BRANCH"), project_dict["id"])
+
+
+def get_checkpoint_ref(project_dict):
+    return get_state_ref(project_dict) + "-checkpoint"
+
+
+def save_branch_data(repo, project_dict, state, filename):
+    """Commits the state to its own branch, keeping at most STATE_HISTORY commits there."""
+    ref = project_dict.get("data_ref")
+    # Stored with the state, so the length of the branch is known without walking it.
+    length = project_dict.get("data_history", 0)
+    i = 1
+    while True:
+        head = ref.object.sha if ref is not None else None
+        if head is not None and length < get_state_history():
+            parents = [GitCommit(repo.requester, attributes={"sha": head}, completed=False)]
+            history = length + 1
+        else:
+            # A new root commit leaves the older snapshots unreachable, for GitHub to collect.
+            parents = []
+            history = 1
+        data = json.dumps({**state, "_meta": get_meta(project_dict), "_history": history})
+        tree = repo.create_git_tree([InputGitTreeElement(filename, "100644", "blob", content=data)])
+        commit = repo.create_git_commit("Update", tree, parents)
+        try:
+            if ref is None:
+                ref = repo.create_git_ref("refs/" + get_state_ref(project_dict), commit.sha)
+            else:
+                # Without force, another run having moved the branch in the meantime fails the update.
+                ref.edit(commit.sha, force=not parents)
+            break
+        except GithubException as e:
+            if e.status in (409, 422) and i <= 3:
+                print("Branch %s moved when pushing updates. Sleeping for %s seconds before retry %s" % (
+                    get_state_ref(project_dict), i * 5, i))
+                time.sleep(i * 5)
+                i += 1
+                ref = repo.get_git_ref(get_state_ref(project_dict))
+                continue
+            raise
+    project_dict["data_ref"] = ref
+    project_dict["data_history"] = history
+
+
+def get_branch_contents(repo, project_dict, filename):
+    ref = repo.get_git_ref(get_state_ref(project_dict))
+    try:
+        head = ref.object.sha
+    except GithubException as e:
+        if e.status != 404:
+            raise
+        # The first save creates the branch, until then the last state is the one on the default branch.
+        print(f"No {get_state_ref(project_dict)} yet, reading {filename} from the default branch")
+        return repo.get_contents(filename)
+    project_dict["data_ref"] = ref
+    return repo.get_contents(filename, ref=head)
+
+
+def get_data(repo, project_dict, create=True):
     filename = f".data/{project_dict['id']}.json"
     try:
-        repo.get_contents(filename)
+        if get_env_var("STATE_BRANCH"):
+            content = get_branch_contents(repo, project_dict, filename)
+        else:
+            content = repo.get_contents(filename)
     except GithubException as e:
+        # Saving to a state branch doesn't need the file to exist.
+        if e.status == 404 and (not create or get_env_var("STATE_BRANCH")):
+            return None
         if e.status == 404:
-            repo.create_file(filename, "Init commit", "")
+            project_dict["data_sha"] = repo.create_file(filename, "Init commit", "")["content"].sha
+            return None
         else:
             raise e
+    project_dict["data_sha"] = content.sha
+    data = content.decoded_content.decode("utf-8")
+    if data:
+        state = json.loads(data)
+        project_dict["data_meta"] = state.pop("_meta", None)
+        project_dict["data_history"] = state.pop("_history", 0)
+        check_meta(project_dict, project_dict["data_meta"])
+        return state
 
 
-def get_data(repo, project_dict):
-    filename = f".data/{project_dict['id']}.json"
-    data = repo.get_contents(filename).decoded_content.decode("utf-8")
-    if data:
-        return json.loads(data)
+def get_checkpoint_every():
+    return int(get_env_var("CHECKPOINT_EVERY") or 20)
+
+
+def get_checkpoint(repo, project_dict):
+    """Returns the ledger of what this run delivered, seeded from a run that failed before saving its state."""
+    if "checkpoint" in project_dict:
+        return project_dict["checkpoint"]
+    # Tied to the snapshot the deliveries were diffed against.
+    checkpoint = {"base": project_dict.get("data_sha"), "comments": {}, "updated": {}, "diffs": [], "pending": 0}
+    project_dict["checkpoint"] = checkpoint
+    try:
+        if get_env_var("STATE_BRANCH"):
+            ref = repo.get_git_ref(get_checkpoint_ref(project_dict))
+            content = repo.get_contents(".data/%s.checkpoint.json" % project_dict["id"], ref=ref.object.sha)
+            project_dict["checkpoint_ref"] = ref
+        else:
+            content = repo.get_contents(".data/%s.checkpoint.json" % project_dict["id"])
+    except GithubException as e:
+        if e.status == 404:
+            return checkpoint
+        raise
+    project_dict["checkpoint_sha"] = content.sha
+    stored = json.loads(content.decoded_content.decode("utf-8"))
+    if stored.get("base") != checkpoint["base"]:
+        # The state was saved since, so everything in it was delivered and is recorded there.
+        print("Ignoring the checkpoint of an older snapshot")
+        return checkpoint
+    checkpoint.update(stored)
+    print("Resuming after %s delivered comments, %s comment updates and %s board changes" % (
+        sum(len(x) for x in checkpoint["comments"].values()), len(checkpoint["updated"]), len(checkpoint["diffs"])))
+    return checkpoint
+
+
+def checkpoint_delivery(repo, project_dict, deliveries=1):
+    checkpoint = project_dict["checkpoint"]
+    checkpoint["pending"] += deliveries
+    if checkpoint["pending"] >= get_checkpoint_every():
+        save_checkpoint(repo, project_dict)
+
+
+def save_checkpoint(repo, project_dict):
+    checkpoint = project_dict.get("checkpoint")
+    if not checkpoint or not checkpoint["pending"]:
+        return
+    filename = ".data/%s.checkpoint.json" % project_dict["id"]
+    data = json.dumps({k: checkpoint[k] for k in ("base", "comments", "updated", "diffs")})
+    if get_env_var("STATE_BRANCH"):
+        # A single root commit on its own branch, so checkpoints don't add to the default branch's history either.
+        tree = repo.create_git_tree([InputGitTreeElement(filename, "100644", "blob", content=data)])
+        commit = repo.create_git_commit("Checkpoint", tree, [])
+        if project_dict.get("checkpoint_ref"):
+            project_dict["checkpoint_ref"].edit(commit.sha, force=True)
+        else:
+            project_dict["checkpoint_ref"] = repo.create_git_ref("refs/" + get_checkpoint_ref(project_dict), commit.sha)
+        project_dict["checkpoint_sha"] = commit.sha
+    elif project_dict.get("checkpoint_sha"):
+        result = repo.update_file(filename, "Checkpoint", data, project_dict["checkpoint_sha"])
+        project_dict["checkpoint_sha"] = result["content"].sha
+    else:
+        result = repo.create_file(filename, "Checkpoint", data)
+        project_dict["checkpoint_sha"] = result["content"].sha
+    checkpoint["pending"] = 0
+    count("checkpoints")
+
+
+def clear_checkpoint(repo, project_dict):
+    if project_dict.get("checkpoint_ref"):
+        project_dict.pop("checkpoint_ref").delete()
+    elif project_dict.get("checkpoint_sha"):
+        repo.delete_file(".data/%s.checkpoint.json" % project_dict["id"], "Clear checkpoint", project_dict["checkpoint_sha"])
+    project_dict.pop("checkpoint_sha", None)
+    project_dict.pop("checkpoint", None)
+
+
+def get_diff_key(diff):
+    return "%s %s" % (diff["issue"]["id"], diff.get("transition", diff["comment"]))
+
+
+def get_meta(project_dict):
+    return {
+        "project": {
+            "id": project_dict["id"],
+            "number": project_dict["number"],
+            "title": project_dict["title"],
+            "url": project_dict["url"],
+        },
+        "pivot_field": project_dict["pivot_field"],
+        "pivot_fields": project_dict["pivot_fields"][1:],
+    }
+
 
+def check_meta(project_dict, meta):
+    # Snapshots written before the metadata was stored have none to compare against.
+    if meta is None:
+        return
+    if meta["pivot_field"]["id"] != project_dict["pivot_field"]["id"]:
+        print(f"Pivot field changed from '{meta['pivot_field']['name']}' to '{project_dict['pivot_field']['name']}'")
+    elif meta["pivot_field"]["digest"] != project_dict["pivot_field"]["digest"]:
+        print(f"Options of pivot field '{project_dict['pivot_field']['name']}' changed since the last run")
 
+
+def is_unchanged(project_dict, current_state, last_state):
+    def get_items(state):
+        return {
+            issue["id"]: (column_id, {k: v for k, v in issue.items() if k != "last_read"})
+            for column_id, column in state.items()
+            for issue in column["issues"].values()
+        }
+
+    # Columns follow the pivot field options, which the metadata covers.
+    if project_dict.get("data_meta") != get_meta(project_dict):
+        return False
+    # Items without last_read (e.g. added by a webhook) need a save to start tracking their comments.
+    if any("last_read" not in issue for column in last_state.values() for issue in column["issues"].values()):
+        return False
+    # last_read is only a comment watermark, when no comment turned up leaving it behind is harmless.
+    return get_items(current_state) == get_items(last_state)
+
+
+@profiled("inherit_states")
 def inherit_states(current_state, last_state):
-    def get_existing_comments(last_state, id):
+    def get_existing_issue(last_state, id):
         if last_state is None:
             return {}
         for column in last_state.values():
-            if (
-                id in column["issues"].keys()
-                and "comments" in column["issues"][id].keys()
-            ):
-                return column["issues"][id]["comments"]
+            if id in column["issues"].keys():
+                return column["issues"][id]
         return {}
 
     current_state = json.loads(json.dumps(current_state))
     for column in current_state.values():
         for k in column["issues"].values():
-            k["comments"] = get_existing_comments(last_state, k["id"])
+            existing = get_existing_issue(last_state, k["id"])
+            k["comments"] = existing.get("comments", {})
+            # Kept for runs that don't save, e.g. server mode saves webhook deliveries without marking them read.
+            if "last_read" in existing:
+                k["last_read"] = existing["last_read"]
     return current_state
 
 
-def diff_states(current_state, last_state):
+def get_diff(issue, last_column, current_column):
+    if last_column is None:
+        comment = "added to the board into `%s` :wave:" % (current_column)
+    elif current_column is None:
+        comment = "removed from the board :broken_heart:"
+    else:
+        comment = "moved from `%s` :point_right: `%s`" % (last_column, current_column)
+    return {"issue": issue, "comment": comment}
+
+
+def get_option_name(field, option_id):
+    if option_id == "no-option-placeholder":
+        return f"No {field['name']}"
+    return next((x["name"] for x in field["options"] if x["id"] == option_id), option_id)
+
+
+def get_item_changes(issue, last_issue, project_dict):
+    """Diffs of an item that stayed on the board, other than moves between columns."""
+    diffs = []
+    for field in project_dict["pivot_fields"][1:]:
+        if field["id"] not in last_issue.get("pivots", {}):
+            # Not a pivot field yet when the last snapshot was taken
+            continue
+        option = issue["pivots"][field["id"]]
+        last_option = last_issue["pivots"][field["id"]]
+        if option != last_option:
+            diff = get_diff(issue, get_option_name(field, last_option), get_option_name(field, option))
+            diff["field"] = field["name"]
+            diffs.append(diff)
+    change = get_field_changes(issue, last_issue, project_dict["tracked_fields"])
+    if change is not None:
+        diffs.append(change)
+    return diffs
+
+
+def get_field_changes(issue, last_issue, tracked_fields):
+    # Equal digests are the common case, the fields are only compared when they differ.
+    if not tracked_fields or issue.get("digest") == last_issue.get("digest"):
+        return None
+    changes = []
+    names = []
+    for field in tracked_fields:
+        if field["id"] is not None and field["name"] not in last_issue.get("fields", {}):
+            # Not tracked yet when the last snapshot was taken
+            continue
+        last_value = get_tracked_value(last_issue, field)
+        value = get_tracked_value(issue, field)
+        if value != last_value:
+            changes.append("changed `%s` from `%s` :point_right: `%s`" % (
+                field["name"], escape_slack_link(str(last_value)), escape_slack_link(str(value))))
+            names.append("`%s`" % field["name"])
+    if not changes:
+        return None
+    # Digests group by which fields changed, the values differ per item.
+    return {"issue": issue, "comment": ", ".join(changes), "transition": "changed " + ", ".join(names)}
+
+
+@profiled("diff_states")
+def diff_states(current_state, last_state, project_dict=None):
     diffs = []
     current_state = json.loads(json.dumps(current_state))
     current_issues = {}
@@ -409,48 +1178,113 @@ def diff_states(current_state, last_state):
         issue, column = diff
         current_column = current_state[current_issues[issue]["column"]]["name"]
         if issue not in last_issues:
-            diffs.append(
-                {
-                    "issue": current_issues[issue]["issue"],
-                    "comment": "added to the board into `%s` :wave:" % (current_column),
-                }
-            )
-
+            diffs.append(get_diff(current_issues[issue]["issue"], None, current_column))
         else:
             last_column = last_state[last_issues[issue]["column"]]["name"]
-            diffs.append(
-                {
-                    "issue": current_issues[issue]["issue"],
-                    "comment": "moved from `%s` :point_right: `%s`"
-                    % (last_column, current_column),
-                }
-            )
+            diffs.append(get_diff(current_issues[issue]["issue"], last_column, current_column))
 
     for diff in last_list.difference(current_list):
         issue, column = diff
         if issue not in current_issues:
-            diffs.append(
-                {
-                    "issue": last_issues[issue]["issue"],
-                    "comment": "removed from the board :broken_heart:",
-                }
-            )
+            diffs.append(get_diff(last_issues[issue]["issue"], last_state[column]["name"], None))
+
+    if project_dict is not None:
+        for issue, current in current_issues.items():
+            if issue in last_issues:
+                diffs.extend(get_item_changes(current["issue"], last_issues[issue]["issue"], project_dict))
 
     return diffs
 
 
-def get_env_var_name(name):
-    if "LOCAL_DEV" in os.environ:
-        return name
-    else:
-        return "INPUT_%s" % name
+# Diffs per notification while streaming, so a long crawl doesn't hold them all back.
+stream_batch_size = 20
 
 
-def get_env_var(name):
-    return os.getenv(get_env_var_name(name))
+class SnapshotStream:
+    """Crawls the board and diffs every page against the last snapshot as it arrives.
 
-def is_env_var_present(name):
-    return get_env_var_name(name) in os.environ and get_env_var(name) != ""
+    Rather than building the full board, then an inherited copy, then index dicts and sets to diff,
+    each item is looked up in an id index of the last snapshot, inherits its comments and last_read,
+    and is dropped from the last snapshot once placed in the new one.
+    """
+
+    def __init__(self, repo, project_dict, cursor=None, pages=None, create=True):
+        self.repo = repo
+        self.project_dict = project_dict
+        # Limits the crawl to one shard of the board, see crawl_shard.
+        self.cursor = cursor
+        self.pages = pages
+        # Shards run concurrently, the reducer creates the data file on the first run.
+        self.create = create
+        self.state = {}
+        self.last_state = None
+        # Column of every item of the last snapshot not seen on a page yet.
+        self.index = None
+        # Whether the new snapshot differs in more than the last_read watermarks.
+        self.changed = False
+
+    def diffs(self, removals=True):
+        pages = iter_state_pages(self.project_dict, self.state, self.cursor, self.pages)
+        while True:
+            records = next_state_page(pages)
+            if records is None:
+                break
+            yield from self.diff_page(records)
+
+        if removals:
+            yield from self.diff_removals()
+
+    @profiled("diff_states")
+    def diff_page(self, records):
+        if self.index is None:
+            # The first page resolved the project, so the data file can be found now.
+            with span("state_read"):
+                self.last_state = get_data(self.repo, self.project_dict, create=self.create)
+            self.index = {}
+            for column in (self.last_state or {}).values():
+                for issue in column["issues"].values():
+                    self.index[issue["id"]] = column["id"]
+
+        diffs = []
+        for option, record in records:
+            current_column = self.state[option]
+            current_column["issues"][record["id"]] = record
+            last_column_id = self.index.pop(record["id"], None)
+            if last_column_id is None:
+                record["comments"] = {}
+                self.changed = True
+                if self.last_state is not None:
+                    diffs.append(get_diff(record, None, current_column["name"]))
+                continue
+
+            last_column = self.last_state[last_column_id]
+            last_record = last_column["issues"].pop(record["id"])
+            record["comments"] = last_record.get("comments", {})
+            if "last_read" in last_record:
+                record["last_read"] = last_record["last_read"]
+            # Without last_read the item needs a save to start tracking its comments.
+            if record != last_record or "last_read" not in record:
+                self.changed = True
+            if last_column_id != option:
+                diffs.append(get_diff(record, last_column["name"], current_column["name"]))
+            diffs.extend(get_item_changes(record, last_record, self.project_dict))
+        return diffs
+
+    @profiled("diff_states")
+    def diff_removals(self):
+        # Whatever wasn't seen on any page left the board.
+        diffs = []
+        for issue_id, last_column_id in (self.index or {}).items():
+            self.changed = True
+            last_column = self.last_state[last_column_id]
+            diffs.append(get_diff(last_column["issues"].pop(issue_id), last_column["name"], None))
+        return diffs
+
+
+@profiled("get_state")
+def next_state_page(pages):
+    # The streaming crawl, one page at a time so diffing and notifying in between count towards their own stages.
+    return next(pages, None)
 
 
 def send_slack(project_dict, text, attachment=None, color="#D3D3D3"):  # grey-ish
@@ -465,22 +1299,34 @@ def send_slack(project_dict, text, attachment=None, color="#D3D3D3"):  # grey-is
             "footer": footer,
         }
 
+    count("slack_messages")
     if use_slack_api:
-        response = slack.chat_postMessage(
-            channel=channel, attachments=[attachment]
-        )
+        with span("slack"):
+            response = slack.chat_postMessage(
+                channel=channel, attachments=[attachment]
+            )
         print("...sent to channel %s" % channel)
         return response
     else:
         body = {
             "attachments": [attachment],
         }
-        response = requests.post(slack_webhook, json=body)
+        with span("slack"):
+            response = requests.post(slack_webhook, json=body)
         print("...sent to webhook")
         return None
 
 
 def convert_to_slack_markdown(gh_text):
+    with span("markdown"):
+        return convert_markdown(gh_text)
+
+
+def convert_markdown(gh_text):
+    # Only runs that post comments need these, keep them off the cold start.
+    import markdown
+    from htmlslacker import HTMLSlacker
+
     html = markdown.markdown(gh_text)
     # later convert back to \n
     html = html.replace("\n", "<br>")
@@ -495,6 +1341,7 @@ def convert_to_slack_markdown(gh_text):
     return slack_markdown
 
 
+@profiled("slack")
 def publish_comment(text, context):
     print(text)
     print(context)
@@ -511,6 +1358,7 @@ def publish_comment(text, context):
     return send_slack(project_dict, text, attachments)
 
 
+@profiled("slack")
 def update_comment(ts, text, context):
     if not use_slack_api:
         print >> sys.stderr, "Slack Incoming Webhooks don't allow updating messages, only posting new messages is possible. Configure Slack API (SLACK_TOKEN & SLACK_CHANNEL) for messages updates."
@@ -529,9 +1377,11 @@ def update_comment(ts, text, context):
             "text": slack_text,
             "footer": context,
         }
-        slack.chat_update(
-            channel=channel, ts=ts, attachments=[attachments]
-        )
+        count("slack_updates")
+        with span("slack"):
+            slack.chat_update(
+                channel=channel, ts=ts, attachments=[attachments]
+            )
     except SlackApiError as e:
         if e.response["error"] == "channel_not_found":
             slack.chat_postMessage(
@@ -542,81 +1392,605 @@ def update_comment(ts, text, context):
             raise e
 
 
+def record_comment(state, issue_id, comment_id, ts):
+    for column in state.values():
+        for issue in column["issues"].values():
+            if issue["id"] == issue_id:
+                issue["comments"][comment_id] = ts
+
+
+def is_comment_recorded(state, issue_id, comment_id):
+    for column in state.values():
+        if issue_id in column["issues"]:
+            return comment_id in column["issues"][issue_id].get("comments", {})
+    return False
+
+
+def merge_comments(state, other_state):
+    """Records the comments only other_state knows about in state, returns whether there were any."""
+    issues = {issue["id"]: issue for column in state.values() for issue in column["issues"].values()}
+    merged = False
+    for column in other_state.values():
+        for issue_id, other_issue in column["issues"].items():
+            if issue_id not in issues:
+                continue
+            comments = issues[issue_id].setdefault("comments", {})
+            for comment_id, ts in other_issue.get("comments", {}).items():
+                if comment_id not in comments:
+                    comments[comment_id] = ts
+                    merged = True
+    return merged
+
+
+# Slack truncates long attachments, keep each message well below that.
+slack_message_limit = 3000
+
+
+def get_digest_threshold():
+    return int(get_env_var("DIGEST_THRESHOLD") or 50)
+
+
+def format_diff(diff):
+    issue_emoji = ":issue-closed:" if diff["issue"]["state"].lower() == "closed" else ":issue:"
+    return "%s <%s|%s> %s" % (
+        issue_emoji,
+        diff["issue"]["html_url"],
+        escape_slack_link(diff["issue"]["title"]),
+        diff["comment"],
+    )
+
+
+def get_digest_lines(diffs):
+    # One line per transition with its count and first few issues, instead of one per issue.
+    top = int(get_env_var("DIGEST_TOP") or 5)
+    transitions = {}
+    for diff in diffs:
+        transitions.setdefault(diff.get("transition", diff["comment"]), []).append(diff)
+
+    lines = []
+    for transition, transition_diffs in sorted(transitions.items(), key=lambda x: len(x[1]), reverse=True):
+        links = ", ".join(
+            "<%s|%s>" % (diff["issue"]["html_url"], escape_slack_link(diff["issue"]["title"]))
+            for diff in transition_diffs[:top]
+        )
+        more = len(transition_diffs) - top
+        lines.append("*%s* %s - %s%s" % (
+            len(transition_diffs), transition, links, " and %s more" % more if more > 0 else ""))
+    return lines
+
+
+def split_messages(lines):
+    messages = []
+    current = []
+    size = 0
+    for line in lines:
+        if current and size + len(line) > slack_message_limit:
+            messages.append("\n".join(current))
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        messages.append("\n".join(current))
+    return messages
+
+
+@profiled("slack")
+def notify_diffs(project_dict, diffs):
+    # One message per pivot field, adds, removes and other field changes go with the first one.
+    fields = {}
+    for diff in diffs:
+        fields.setdefault(diff.get("field", project_dict["pivot_field"]["name"]), []).append(diff)
+
+    for field, field_diffs in fields.items():
+        if len(field_diffs) > get_digest_threshold():
+            lines = get_digest_lines(field_diffs)
+        else:
+            lines = [format_diff(diff) for diff in sorted(field_diffs, key=lambda k: k["comment"])]
+        if len(project_dict["pivot_fields"]) > 1:
+            lines.insert(0, "*%s*" % field)
+        # green if all closed, blue otherwise
+        closed = all(diff["issue"]["state"].lower() == "closed" for diff in field_diffs)
+        color = "#36a64f" if closed else "#439FE0"
+        for text in split_messages(lines):
+            send_slack(project_dict, text, color=color)
+
+
+def sync_comments(repo, project_dict, current_state, last_state, comments_by_issue=None):
+    """Posts new comments and updates edited ones, returns whether there were any."""
+    if comments_by_issue is None:
+        with span("comments"):
+            comments_by_issue = get_comments(project_dict, last_state)
+    found = any(c["comments"] or c["comments_update"] for c in comments_by_issue.values())
+    if not found:
+        return False
+
+    checkpoint = get_checkpoint(repo, project_dict)
+    for issue_id, delivered in checkpoint["comments"].items():
+        for comment_id, ts in delivered.items():
+            record_comment(current_state, issue_id, comment_id, ts)
+    for issue_with_comments in comments_by_issue.values():
+        for new_comment in issue_with_comments["comments"]:
+            if is_comment_recorded(current_state, issue_with_comments["issue_id"], new_comment["id"]):
+                # Already delivered, e.g. by a webhook in server mode or a run that failed to save
+                print(f" skipping delivered comment {new_comment['url']}")
+                continue
+            context = "*%s* commented on <%s|%s>" % (
+                new_comment["author"]["login"],
+                new_comment["url"],
+                escape_slack_link(issue_with_comments["issue_title"]),
+            )
+            response = publish_comment(new_comment["body"], context)
+            if response is not None:
+                record_comment(current_state, issue_with_comments["issue_id"], new_comment["id"], response["ts"])
+                checkpoint["comments"].setdefault(issue_with_comments["issue_id"], {})[new_comment["id"]] = response["ts"]
+                checkpoint_delivery(repo, project_dict)
+        for updated_comment in issue_with_comments["comments_update"]:
+            if checkpoint["updated"].get(updated_comment["id"]) == updated_comment["updatedAt"]:
+                print(f" skipping delivered update of {updated_comment['url']}")
+                continue
+            for column in current_state.values():
+                for issue in column["issues"].values():
+                    for id in issue["comments"].keys():
+                        if id == updated_comment["id"]:
+                            context = "*%s* updated comment on <%s|%s>" % (
+                                updated_comment["author"]["login"],
+                                updated_comment["url"],
+                                escape_slack_link(issue_with_comments["issue_title"]),
+                            )
+                            update_comment(issue["comments"][id], updated_comment["body"], context)
+                            checkpoint["updated"][updated_comment["id"]] = updated_comment["updatedAt"]
+                            checkpoint_delivery(repo, project_dict)
+    return found
+
+
 def main(repo, project_dict):
-    init_data(repo, project_dict)
+    if get_env_var("STREAMING") == "true":
+        return main_streaming(repo, project_dict)
 
-    # Now do stuff.
-    last_state = get_data(repo, project_dict)
+    # The first page of items resolves the project, so crawl before touching the data file.
     current_state = get_state(project_dict)
-    current_state = inherit_states(current_state, last_state)
+    with span("state_read"):
+        # Now do stuff.
+        last_state = get_data(repo, project_dict)
+    with span("inherit"):
+        current_state = inherit_states(current_state, last_state)
 
+    comments_found = False
     if get_env_var("TRACK_ISSUES").lower() == 'true':
-        comments_by_issue = get_comments(project_dict, last_state)
-        for issue_with_comments in comments_by_issue.values():
-            for new_comment in issue_with_comments["comments"]:
-                context = "*%s* commented on <%s|%s>" % (
-                    new_comment["author"]["login"],
-                    new_comment["url"],
-                    escape_slack_link(issue_with_comments["issue_title"]),
-                )
-                response = publish_comment(new_comment["body"], context)
-                if response is not None:
-                    for column in current_state.values():
-                        for issue in column["issues"].values():
-                            if issue["id"] == issue_with_comments["issue_id"]:
-                                issue["comments"][new_comment["id"]] = response["ts"]
-            for updated_comment in issue_with_comments["comments_update"]:
-                for column in current_state.values():
-                    for issue in column["issues"].values():
-                        for id in issue["comments"].keys():
-                            if id == updated_comment["id"]:
-                                context = "*%s* updated comment on <%s|%s>" % (
-                                    updated_comment["author"]["login"],
-                                    updated_comment["url"],
-                                    escape_slack_link(issue_with_comments["issue_title"]),
-                                )
-                                update_comment(issue["comments"][id], updated_comment["body"], context)
-
-    save_data(repo, project_dict, current_state)
+        comments_found = sync_comments(repo, project_dict, current_state, last_state)
+
+    if last_state:
+        with span("diff"):
+            diffs = diff_states(current_state, last_state, project_dict)
+        count("diffs", len(diffs))
+        if not diffs and not comments_found and is_unchanged(project_dict, current_state, last_state):
+            print("Nothing changed since the last run, exiting.")
+            count("saves_skipped")
+            return current_state
+
+    with span("state_write"):
+        save_data(repo, project_dict, current_state)
 
     if not last_state:
         print("No last state found, exiting.")
-        sys.exit()
+        return current_state
 
-    diffs = diff_states(current_state, last_state)
     if not diffs:
         print("No difference found, exiting.")
-        sys.exit()
+        return current_state
 
+    notify_diffs(project_dict, diffs)
+    return current_state
 
-    msgs = []
-    diffs = sorted(diffs, key=lambda k: k["comment"])
-    for diff in diffs:
-        issue_emoji = ":issue-closed:" if diff["issue"]["state"] == "closed" else ":issue:"
-        color = (
-            "#36a64f" if diff["issue"]["state"] == "closed" else "#439FE0"
-        )  # green if closed, blue otherwise
-        msgs.append(
-            "%s <%s|%s> %s"
-            % (
-                issue_emoji,
-                diff["issue"]["html_url"],
-                escape_slack_link(diff["issue"]["title"]),
-                diff["comment"],
-            )
+
+def main_streaming(repo, project_dict):
+    stream = SnapshotStream(repo, project_dict)
+    diffs = []
+    sent = 0
+    for diff in stream.diffs():
+        count("diffs")
+        checkpoint = get_checkpoint(repo, project_dict)
+        if get_diff_key(diff) in checkpoint["diffs"]:
+            # Sent early by a run that failed to save
+            continue
+        diffs.append(diff)
+        # Don't hold notifications back until the crawl is done, unless they're going to end up in a digest.
+        if len(diffs) >= stream_batch_size and sent + len(diffs) <= get_digest_threshold():
+            notify_diffs(project_dict, diffs)
+            checkpoint["diffs"].extend(get_diff_key(x) for x in diffs)
+            checkpoint_delivery(repo, project_dict, len(diffs))
+            sent += len(diffs)
+            diffs = []
+
+    return complete_run(repo, project_dict, stream.state, stream.last_state is not None, stream.changed, diffs)
+
+
+def complete_run(repo, project_dict, state, has_last_state, changed, diffs, comments_by_issue=None):
+    # The rest of a run once the new snapshot is diffed and carries over comments and last_read.
+    comments_found = False
+    if get_env_var("TRACK_ISSUES").lower() == 'true':
+        comments_found = sync_comments(repo, project_dict, state, state if has_last_state else None, comments_by_issue)
+
+    if has_last_state and not changed and not comments_found \
+            and project_dict.get("data_meta") == get_meta(project_dict):
+        print("Nothing changed since the last run, exiting.")
+        count("saves_skipped")
+        return state
+
+    with span("state_write"):
+        save_data(repo, project_dict, state)
+
+    if diffs:
+        notify_diffs(project_dict, diffs)
+    return state
+
+
+def get_shard_dir():
+    return get_env_var("SHARD_DIR") or "shards"
+
+
+def fetch_project_cursors_page(project_dict, cursor, page_size):
+    after = f"after: \"{cursor}\", " if isinstance(cursor, str) else ""
+    header = "" if isinstance(cursor, str) else project_header
+    query = gql(
+        f"""
+        query {{
+            rateLimit {{
+                cost
+            }}
+            organization(login: "{project_dict['owner']['login']}") {{
+                projectNext(number: {project_dict['number']}) {{
+                    {header}
+                    items({after}first: {page_size}) {{
+                        pageInfo {{
+                            endCursor
+                            hasNextPage
+                        }}
+                    }}
+                }}
+            }}
+        }}
+    """
+    )
+    result = run_query(query)
+    return result["organization"]["projectNext"]
+
+
+def plan_shards(project_dict):
+    """Splits the board into SHARDS ranges of item pages, for crawl_shard to work through in parallel."""
+    shards = int(get_env_var("SHARDS") or 4)
+    page_size = 100
+    # Paging without any item fields is cheap, it only collects where each page starts.
+    page = fetch_project_cursors_page(project_dict, None, page_size)
+    set_project(project_dict, page)
+    cursors = [None]
+    while page["items"]["pageInfo"]["hasNextPage"]:
+        cursors.append(page["items"]["pageInfo"]["endCursor"])
+        page = fetch_project_cursors_page(project_dict, cursors[-1], page_size)
+
+    pages = -(-len(cursors) // shards)
+    starts = list(range(0, len(cursors), pages))
+    plan = {
+        "project": {k: project_dict[k] for k in ("id", "title", "url", "pivot_field", "pivot_fields", "tracked_fields")},
+        # The last shard reads to the end of the board, in case items were added since planning.
+        "shards": [
+            {"index": i, "after": cursors[start], "pages": pages if i < len(starts) - 1 else None}
+            for i, start in enumerate(starts)
+        ],
+    }
+    print(f"Planned {len(plan['shards'])} shards of {pages} pages for {len(cursors)} pages")
+    os.makedirs(get_shard_dir(), exist_ok=True)
+    with open(os.path.join(get_shard_dir(), "plan.json"), "w") as f:
+        json.dump(plan, f)
+    if os.getenv("GITHUB_OUTPUT"):
+        # For a matrix over the shards, e.g. `shard: ${{ fromJSON(needs.plan.outputs.shards) }}`
+        with open(os.getenv("GITHUB_OUTPUT"), "a") as f:
+            f.write("shards=%s\n" % json.dumps([x["index"] for x in plan["shards"]]))
+    return plan
+
+
+def read_plan(project_dict):
+    with open(os.path.join(get_shard_dir(), "plan.json")) as f:
+        plan = json.load(f)
+    project_dict.update(plan["project"])
+    return plan
+
+
+def crawl_shard(repo, project_dict, index):
+    """Crawls and diffs one planned range of pages, and writes the partial snapshot for reduce_shards."""
+    shard = read_plan(project_dict)["shards"][index]
+    stream = SnapshotStream(repo, project_dict, shard["after"], shard["pages"], create=False)
+    # Removals need every shard's items, they are left to the reducer.
+    diffs = list(stream.diffs(removals=False))
+    comments = {}
+    if get_env_var("TRACK_ISSUES").lower() == 'true' and stream.last_state is not None:
+        # Fetched here rather than by the reducer, so the comments of a huge board are fetched in parallel too.
+        with span("comments"):
+            comments = get_shard_comments(project_dict, stream.state)
+    partial = {
+        "state": stream.state,
+        "diffs": diffs,
+        "changed": stream.changed,
+        "labelled_items": sorted(project_dict["labelled_items"]),
+        "comments": comments,
+    }
+    with open(os.path.join(get_shard_dir(), "shard-%s.json" % index), "w") as f:
+        json.dump(partial, f)
+    print(f"Shard {index}: {sum(len(x['issues']) for x in stream.state.values())} items, {len(diffs)} diffs")
+
+
+@profiled("get_comments")
+def get_shard_comments(project_dict, state):
+    issue_last_read = get_issue_last_read(state)
+    issue_ids = project_dict["labelled_items"] if labels else issue_last_read.keys()
+    issue_ids = sorted(x for x in issue_ids if x in issue_last_read)
+    print(f" Fetching comments for {len(issue_ids)} issues of the shard")
+    return get_comments_by_ids(issue_ids, issue_last_read)
+
+
+def recheck_item(project_dict, state, issue, last_column_id, item_id):
+    """Fetches an item no shard saw but which is still on the board, returns its diffs or None if it can't be placed."""
+    node = fetch_project_item(item_id)
+    if node is None or not node["content"]:
+        return None
+    option, record = get_item(node, project_dict)
+    if option not in state:
+        return None
+    # Placed where the last snapshot had it, so a move since shows up as one.
+    state.get(last_column_id, state[option])["issues"][issue["id"]] = issue
+    return apply_item_event(state, record, option, project_dict)
+
+
+def reduce_shards(repo, project_dict):
+    """Merges the partial snapshots into one, finds removed items and sends the combined notification."""
+    plan = read_plan(project_dict)
+    state = get_columns(project_dict["pivot_field"])
+    diffs = {}
+    changed = False
+    comments_by_issue = {}
+    project_dict["labelled_items"] = set()
+    for shard in plan["shards"]:
+        with open(os.path.join(get_shard_dir(), "shard-%s.json" % shard["index"])) as f:
+            partial = json.load(f)
+        for column_id, column in partial["state"].items():
+            state[column_id]["issues"].update(column["issues"])
+        # Items shifted across a shard boundary while crawling are seen by both shards.
+        for diff in partial["diffs"]:
+            diffs.setdefault(get_diff_key(diff), diff)
+        changed = changed or partial["changed"]
+        project_dict["labelled_items"].update(partial["labelled_items"])
+        comments_by_issue.update(partial.get("comments", {}))
+    diffs = list(diffs.values())
+
+    with span("state_read"):
+        last_state = get_data(repo, project_dict)
+    if last_state is not None:
+        seen = set()
+        for column in state.values():
+            seen.update(column["issues"])
+        unseen = [issue["id"] for column in last_state.values() for issue in column["issues"].values() if issue["id"] not in seen]
+        # Reordering the board after planning can move an item into a range that was already crawled.
+        on_board = find_project_items(project_dict, unseen) if unseen else {}
+        for column in last_state.values():
+            for issue in column["issues"].values():
+                if issue["id"] in seen:
+                    continue
+                item_diffs = None
+                if issue["id"] in on_board:
+                    item_diffs = recheck_item(project_dict, state, issue, column["id"], on_board[issue["id"]])
+                if item_diffs is None:
+                    diffs.append(get_diff(issue, column["name"], None))
+                else:
+                    print(f"Item {issue['id']} was missed by the shards, still on the board")
+                    diffs.extend(item_diffs)
+                changed = True
+    count("diffs", len(diffs))
+    return complete_run(repo, project_dict, state, last_state is not None, changed, diffs, comments_by_issue)
+
+
+def apply_item_event(state, issue, option, project_dict=None):
+    # Mirrors diff_states for a single item, so webhook deliveries don't need a board crawl.
+    last_column = None
+    record = None
+    for column in state.values():
+        if issue["id"] in column["issues"]:
+            last_column = column
+            record = column["issues"].pop(issue["id"])
+            break
+
+    if record is not None:
+        issue["comments"] = record.get("comments", {})
+        if "last_read" in record:
+            issue["last_read"] = record["last_read"]
+    else:
+        issue["comments"] = {}
+    state[option]["issues"][issue["id"]] = issue
+
+    if last_column is None:
+        return [get_diff(issue, None, state[option]["name"])]
+    diffs = []
+    if last_column["id"] != option:
+        diffs.append(get_diff(issue, last_column["name"], state[option]["name"]))
+    if project_dict is not None:
+        diffs.extend(get_item_changes(issue, record, project_dict))
+    return diffs
+
+
+def remove_item_event(state, content_id):
+    for column in state.values():
+        if content_id in column["issues"]:
+            issue = column["issues"].pop(content_id)
+            return [get_diff(issue, column["name"], None)]
+    return []
+
+
+def handle_item_event(project_dict, state, action, item):
+    # projects_v2_item deliveries carry PVT_/PVTI_ ids, the older projects_next_item ones the ProjectNext ids.
+    if item.get("project_node_id") not in (project_dict["id"], project_dict.get("v2_id")):
+        print(f"Ignoring item event for another project: {item.get('project_node_id')}")
+        return []
+    if item.get("content_type", "Issue") != "Issue":
+        # Draft Issue or Pull Request
+        return []
+
+    if action in ("deleted", "archived"):
+        return remove_item_event(state, item["content_node_id"])
+
+    if item["project_node_id"] == project_dict["id"]:
+        item_id = item["node_id"]
+    else:
+        item_id = find_project_item(project_dict, item["content_node_id"])
+    node = fetch_project_item(item_id) if item_id else None
+    if node is None or not node["content"]:
+        return []
+    option, issue = get_item(node, project_dict)
+    if option not in state:
+        # The pivot field gained an option since the last crawl; leave it to reconciliation.
+        print(f"Unknown pivot field option {option}, waiting for reconciliation")
+        return []
+    return apply_item_event(state, issue, option, project_dict)
+
+
+def handle_comment_event(state, action, payload):
+    issue = payload["issue"]
+    comment = payload["comment"]
+    issue_id = issue["node_id"]
+    if not any(issue_id in column["issues"] for column in state.values()):
+        print(f"Ignoring comment on issue {issue['html_url']} (not on the board)")
+        return False
+    if not filter_labels([x["name"] for x in issue.get("labels", [])], labels):
+        print(f"skipping issue {issue['html_url']} (no matching label)")
+        return False
+
+    if action == "created":
+        if is_comment_recorded(state, issue_id, comment["node_id"]):
+            return False
+        context = "*%s* commented on <%s|%s>" % (
+            comment["user"]["login"],
+            comment["html_url"],
+            escape_slack_link(issue["title"]),
         )
+        response = publish_comment(comment["body"], context)
+        if response is not None:
+            record_comment(state, issue_id, comment["node_id"], response["ts"])
+            return True
+    elif action == "edited":
+        for column in state.values():
+            ts = column["issues"].get(issue_id, {}).get("comments", {}).get(comment["node_id"])
+            if ts is not None:
+                context = "*%s* updated comment on <%s|%s>" % (
+                    comment["user"]["login"],
+                    comment["html_url"],
+                    escape_slack_link(issue["title"]),
+                )
+                update_comment(ts, comment["body"], context)
+    return False
 
-    msgs = "\n".join(msgs)
 
-    send_slack(project_dict, msgs, color=color)
+def verify_signature(secret, body, signature):
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest("sha256=" + expected, signature)
+
+
+class WebhookServer:
+    def __init__(self, repo, project_dict):
+        self.repo = repo
+        self.project_dict = project_dict
+        self.lock = threading.Lock()
+        self.secret = get_env_var("WEBHOOK_SECRET")
+        self.reconcile_interval = int(get_env_var("RECONCILE_INTERVAL") or 900)
+        self.state = None
+
+    def reconcile(self):
+        # A crawl takes minutes on big boards, deliveries keep being applied to the old state meanwhile.
+        print("Reconciling board state")
+        # Its own copy, so a delivery's save doesn't clear the checkpoint or data file sha of the crawl.
+        project_dict = dict(self.project_dict)
+        try:
+            state = main(self.repo, project_dict)
+        finally:
+            if project_dict.get("checkpoint"):
+                save_checkpoint(self.repo, project_dict)
+        with self.lock:
+            self.project_dict.update(project_dict)
+            # Comments delivered during the crawl may have been saved after the crawl read the snapshot.
+            if self.state is not None and merge_comments(state, self.state):
+                save_data(self.repo, self.project_dict, state, mark_read=False)
+            self.state = state
+
+    def reconcile_forever(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"Reconciliation failed: {e!r}")
+
+    def handle(self, event, payload):
+        with self.lock:
+            action = payload.get("action")
+            changed = False
+            if event in ("projects_v2_item", "projects_next_item"):
+                item = payload.get("projects_v2_item") or payload.get("projects_next_item")
+                diffs = handle_item_event(self.project_dict, self.state, action, item)
+                if diffs:
+                    notify_diffs(self.project_dict, diffs)
+                changed = bool(diffs)
+            elif event == "issue_comment" and get_env_var("TRACK_ISSUES").lower() == 'true':
+                changed = handle_comment_event(self.state, action, payload)
+
+            if changed:
+                # Leave last_read alone so reconciliation still covers events we never received.
+                save_data(self.repo, self.project_dict, self.state, mark_read=False)
+            return changed
+
+    def serve(self):
+        if not self.secret:
+            print("WEBHOOK_SECRET is required in server mode.")
+            sys.exit(1)
+
+        self.reconcile()
+        self.project_dict["v2_id"] = fetch_project_v2_id(self.project_dict)
+        threading.Thread(target=self.reconcile_forever, daemon=True).start()
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not verify_signature(server.secret, body, self.headers.get("X-Hub-Signature-256")):
+                    self.send_error(401, "Invalid signature")
+                    return
+                event = self.headers.get("X-GitHub-Event", "")
+                try:
+                    changed = server.handle(event, json.loads(body))
+                except Exception as e:
+                    print(f"Failed to handle {event} delivery: {e!r}")
+                    self.send_error(500)
+                    return
+                response = json.dumps({"event": event, "changed": changed}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+        port = int(get_env_var("SERVER_PORT") or 8080)
+        print(f"Listening for webhook deliveries on port {port}")
+        http.server.ThreadingHTTPServer(("", port), Handler).serve_forever()
 
 
 # Get bits
 use_slack_api = is_env_var_present(
     "SLACK_TOKEN") and is_env_var_present("SLACK_CHANNEL")
 use_slack_webhook = is_env_var_present("SLACK_WEBHOOK")
+# Only the reduce step of a sharded run notifies, the plan and shard jobs need no Slack configuration.
+notifies = get_env_var("MODE") not in ("plan", "shard")
 
-if use_slack_api == use_slack_webhook:
+if notifies and use_slack_api == use_slack_webhook:
     if use_slack_api is True:
         print("Both Slack API (SLACK_TOKEN & SLACK_CHANNEL) and Slack Incoming Webhook (SLACK_WEBHOOK) are configured. Update configuration to use only one.")
     else:
@@ -634,21 +2008,51 @@ else:
     labels = []
 
 
-slack = WebClient(token=get_env_var("SLACK_TOKEN"))
+if notifies and use_slack_api:
+    # The Slack SDK is only needed for the API, webhook deployments skip importing it.
+    from slack import WebClient
+    from slack.errors import SlackApiError
+
+    slack = WebClient(token=get_env_var("SLACK_TOKEN"), base_url=os.getenv("SLACK_API_URL", "https://www.slack.com/api/"))
 channel = get_env_var("SLACK_CHANNEL")
 slack_webhook = get_env_var("SLACK_WEBHOOK")
 
+instrument_requests()
+if http_cache_dir:
+    install_http_cache()
+project_dict = {}
 try:
     # Subject to GitHub RateLimitExceededException
-    github = Github(get_env_var("PAT") or os.getenv("GITHUB_SCRIPT_TOKEN"))
-    repo = github.get_repo(get_env_var("REPO_FOR_DATA"))
-
-    transport = AIOHTTPTransport(url='https://api.github.com/graphql', headers={
-                                 'Authorization': 'Bearer %s' % get_env_var("PAT")})
-    # Create a GraphQL client using the defined transport
-    gql_client = Client(transport=transport, fetch_schema_from_transport=True)
-    project_dict = resolve_url(gql_client, get_env_var("PROJECT_URL"))
-
-    main(repo, project_dict)
+    with span("resolve"):
+        github = Github(get_env_var("PAT") or os.getenv("GITHUB_SCRIPT_TOKEN"), base_url=api_url)
+        repo = github.get_repo(get_env_var("REPO_FOR_DATA"))
+
+        # requests is already loaded for PyGithub, the aiohttp transport would add a second HTTP stack to the cold start.
+        transport = RequestsHTTPTransport(url=graphql_url, headers={
+                                     'Authorization': 'Bearer %s' % get_env_var("PAT")})
+        # Create a GraphQL client using the defined transport
+        # Queries are validated by GitHub, downloading the schema every run only costs time.
+        gql_client = Client(transport=transport, fetch_schema_from_transport=False)
+        project_dict = resolve_url(get_env_var("PROJECT_URL"))
+
+    if get_env_var("MODE") == "server":
+        WebhookServer(repo, project_dict).serve()
+    elif get_env_var("MODE") == "plan":
+        plan_shards(project_dict)
+    elif get_env_var("MODE") == "shard":
+        crawl_shard(repo, project_dict, int(get_env_var("SHARD_INDEX")))
+    elif get_env_var("MODE") == "reduce":
+        reduce_shards(repo, project_dict)
+    else:
+        main(repo, project_dict)
 except RateLimitExceededException:
     print("Hit GitHub RateLimitExceededException. Skipping this run.")
+finally:
+    # Only left over when the run failed before saving its state: keep what was already sent to Slack
+    # for the next run, or it sends it again.
+    if project_dict.get("checkpoint"):
+        save_checkpoint(repo, project_dict)
+    if http_cache_dir:
+        prune_http_cache()
+    write_profiles()
+    write_metrics(project_dict)
@@ -1,19 +1,34 @@
-from datetime import datetime, timedelta
-from github import Github, GithubException, RateLimitExceededException, Issue, Organization
+from datetime import datetime, timedelta, timezone
+from github import Github, GithubException, RateLimitExceededException, Organization
 from htmlslacker import HTMLSlacker
 from slack import WebClient
 from slack.errors import SlackApiError
+from concurrent.futures import ThreadPoolExecutor
+from gql import gql, Client
+from gql.transport.aiohttp import AIOHTTPTransport
+import base64
 import codecs
+import contextlib
+import cProfile
+import functools
+import hashlib
 import json
 import markdown
 import os
+import pstats
 import re
 import requests
+import resource
 import sys
+import threading
 import time
+import tracemalloc
 import urllib
 
 datetime_format = "%Y-%m-%dT%H:%M:%SZ"
+# Set by GitHub Actions, overridable to run against a local stand-in (see bench/).
+api_url = os.getenv("GITHUB_API_URL", "https://api.github.com")
+graphql_url = os.getenv("GITHUB_GRAPHQL_URL", api_url + "/graphql")
 
 
 def escape_slack_link(original):
@@ -27,42 +42,585 @@ def get_now():
     return current_time
 
 
-def get_state(project):
+def get_env_var_name(name):
+    if "LOCAL_DEV" in os.environ:
+        return name
+    else:
+        return "INPUT_%s" % name
+
+
+def get_env_var(name):
+    return os.getenv(get_env_var_name(name))
+
+def is_env_var_present(name):
+    return get_env_var_name(name) in os.environ and get_env_var(name) != ""
+
+
+metrics = {"spans": {}, "counters": {}}
+metrics_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = metrics["spans"].setdefault(name, {"count": 0, "seconds": 0.0, "max_rss_kb": 0})
+        entry["count"] += 1
+        entry["seconds"] += time.perf_counter() - started
+        # ru_maxrss is the high-water mark so far, in KiB on Linux
+        entry["max_rss_kb"] = max(entry["max_rss_kb"], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def count(name, value=1):
+    with metrics_lock:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + value
+
+
+def instrument_requests():
+    # PyGithub and the Slack webhook both go through requests, count their calls at the transport.
+    send = requests.Session.send
+
+    def counted_send(self, request, **kwargs):
+        response = send(self, request, **kwargs)
+        kind = "rest" if request.url.startswith(api_url) else "webhook"
+        count(f"{kind}_calls")
+        count(f"{kind}_bytes", len(response.content))
+        return response
+
+    requests.Session.send = counted_send
+
+
+http_cache_dir = get_env_var("HTTP_CACHE_DIR")
+
+
+def get_http_cache_path(request):
+    # ETags differ per token, which only goes into the key hashed.
+    key = "\n".join([request.url, request.headers.get("Accept", ""), request.headers.get("Authorization", "")])
+    return os.path.join(http_cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def get_cached_response(request, response, entry):
+    cached = requests.Response()
+    cached.status_code = 200
+    cached.reason = "OK"
+    cached.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+    # Keeps the rate limit headers of the 304 current.
+    cached.headers.update(response.headers)
+    cached._content = base64.b64decode(entry["body"])
+    cached.encoding = requests.utils.get_encoding_from_headers(cached.headers)
+    cached.url = request.url
+    cached.request = request
+    cached.connection = response.connection
+    cached.elapsed = response.elapsed
+    return cached
+
+
+def install_http_cache():
+    """Revalidates REST GETs against the responses kept in HTTP_CACHE_DIR, GitHub doesn't count 304s against the rate limit."""
+    os.makedirs(http_cache_dir, exist_ok=True)
+    send = requests.Session.send
+
+    def cached_send(self, request, **kwargs):
+        if request.method != "GET" or not request.url.startswith(api_url):
+            return send(self, request, **kwargs)
+        path = get_http_cache_path(request)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None:
+            if entry["etag"]:
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+        response = send(self, request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            count("http_cache_hits")
+            # Recency for the LRU eviction in prune_http_cache
+            os.utime(path)
+            return get_cached_response(request, response, entry)
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            headers = {k: v for k, v in response.headers.items()
+                       if k.lower() not in ("content-length", "content-encoding", "transfer-encoding")}
+            entry = {
+                "url": request.url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "headers": headers,
+                "body": base64.b64encode(response.content).decode("ascii"),
+            }
+            # Written aside and renamed, so other threads never read half an entry.
+            temp = "%s.%s.tmp" % (path, threading.get_ident())
+            with open(temp, "w") as f:
+                json.dump(entry, f)
+            os.replace(temp, path)
+        return response
+
+    requests.Session.send = cached_send
+
+
+def prune_http_cache():
+    """Evicts the least recently used responses once HTTP_CACHE_DIR outgrows HTTP_CACHE_MAX_MB."""
+    limit = float(get_env_var("HTTP_CACHE_MAX_MB") or 50) * 1024 * 1024
+    entries = []
+    for name in os.listdir(http_cache_dir):
+        stat = os.stat(os.path.join(http_cache_dir, name))
+        entries.append((stat.st_mtime, stat.st_size, os.path.join(http_cache_dir, name)))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        os.remove(path)
+        total -= size
+        count("http_cache_evictions")
+
+
+def run_query(query):
+    result = gql_client.execute(query)
+    count("graphql_queries")
+    count("graphql_bytes", len(json.dumps(result)))
+    count("graphql_cost", result.get("rateLimit", {}).get("cost", 0))
+    return result
+
+
+profile_dir = get_env_var("PROFILE_DIR")
+profiles = {}
+profile_lock = threading.Lock()
+if profile_dir:
+    tracemalloc.start()
+
+
+def profiled(stage):
+    # Unless PROFILE_DIR is set the function is handed back untouched, so normal runs pay nothing.
+    def decorate(fn):
+        if not profile_dir:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # Only one profiler can be active, nested and concurrent calls count towards the outer stage.
+            if not profile_lock.acquire(blocking=False):
+                return fn(*args, **kwargs)
+            try:
+                profile = profiles.setdefault(
+                    stage, {"cpu": cProfile.Profile(), "calls": 0, "peak": 0, "allocations": {}})
+                before = tracemalloc.take_snapshot()
+                tracemalloc.reset_peak()
+                profile["cpu"].enable()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    profile["cpu"].disable()
+                    profile["calls"] += 1
+                    profile["peak"] = max(profile["peak"], tracemalloc.get_traced_memory()[1])
+                    for stat in tracemalloc.take_snapshot().compare_to(before, "lineno"):
+                        site = str(stat.traceback)
+                        size, blocks = profile["allocations"].get(site, (0, 0))
+                        profile["allocations"][site] = (size + stat.size_diff, blocks + stat.count_diff)
+            finally:
+                profile_lock.release()
+
+        return wrapper
+
+    return decorate
+
+
+def write_profiles():
+    if not profile_dir:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    for stage, profile in profiles.items():
+        path = os.path.join(profile_dir, stage)
+        # Open with `python -m pstats` or snakeviz
+        profile["cpu"].dump_stats(path + ".prof")
+        with open(path + ".txt", "w") as f:
+            pstats.Stats(profile["cpu"], stream=f).sort_stats("cumulative").print_stats(40)
+        with open(path + ".alloc.txt", "w") as f:
+            f.write("%s: %d calls, peak traced memory %.1f KiB\n\n" % (stage, profile["calls"], profile["peak"] / 1024))
+            f.write("%12s %10s  %s\n" % ("KiB", "blocks", "allocation site"))
+            top = sorted(profile["allocations"].items(), key=lambda item: abs(item[1][0]), reverse=True)[:25]
+            for site, (size, blocks) in top:
+                f.write("%12.1f %10d  %s\n" % (size / 1024, blocks, site))
+    print(f"Wrote profiles for {', '.join(profiles)} to {profile_dir}")
+
+
+def write_metrics(project_dict):
+    labels = 'project="%s"' % project_dict.get("id", "")
+    filename = get_env_var("METRICS_FILE")
+    if filename:
+        if filename.endswith(".prom") or filename.endswith(".txt"):
+            lines = ["# TYPE project_sync_phase_seconds counter"]
+            for name, entry in metrics["spans"].items():
+                lines.append('project_sync_phase_seconds_total{%s,phase="%s"} %f' % (labels, name, entry["seconds"]))
+            lines.append("# TYPE project_sync_phase counter")
+            for name, entry in metrics["spans"].items():
+                lines.append('project_sync_phase_total{%s,phase="%s"} %d' % (labels, name, entry["count"]))
+            for name, value in metrics["counters"].items():
+                lines.append("# TYPE project_sync_%s counter" % name)
+                lines.append("project_sync_%s_total{%s} %d" % (name, labels, value))
+            lines.append("# EOF")
+            output = "\n".join(lines) + "\n"
+        else:
+            output = json.dumps({"project": project_dict.get("id"), "time": get_now(), **metrics}, indent=2)
+        with open(filename, "w") as f:
+            f.write(output)
+
+    summary = os.getenv("GITHUB_STEP_SUMMARY")
+    if summary:
+        with open(summary, "a") as f:
+            f.write("### Project sync for %s\n\n" % project_dict.get("name", project_dict.get("id", "")))
+            f.write("| Phase | Count | Seconds | Peak RSS (MiB) |\n| --- | ---: | ---: | ---: |\n")
+            for name, entry in metrics["spans"].items():
+                f.write("| %s | %d | %.2f | %.1f |\n" % (name, entry["count"], entry["seconds"], entry["max_rss_kb"] / 1024))
+            f.write("\n| Counter | Value |\n| --- | ---: |\n")
+            for name, value in metrics["counters"].items():
+                f.write("| %s | %d |\n" % (name, value))
+            f.write("\n")
+
+
+def get_board_issue(content):
+    return {
+        "id": str(content.id),
+        "number": content.number,
+        "html_url": content.html_url,
+        "title": content.title,
+        "labels": [label.name for label in content.labels],
+        # Taken from the url, content.repository would lazily fetch the repository.
+        "repo": "/".join(content.html_url.split("/")[3:5]),
+        "issue": content,
+    }
+
+
+class ConcurrencyLimit:
+    # A semaphore whose size can shrink while it's in use.
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *args):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def back_off(self):
+        with self.condition:
+            if self.limit > 1:
+                self.limit = self.limit // 2
+                print("Secondary rate limit hit, lowering crawl concurrency to %s" % self.limit)
+
+
+def is_secondary_rate_limit(e):
+    return e.status in (403, 429) and "secondary rate limit" in str(e.data).lower()
+
+
+def call_with_backoff(limit, fn, *args):
+    attempt = 0
+    while True:
+        with limit:
+            try:
+                return fn(*args)
+            except GithubException as e:
+                if not is_secondary_rate_limit(e) or attempt >= 5:
+                    raise
+                attempt += 1
+                retry_after = int((e.headers or {}).get("retry-after", 2 ** attempt))
+        limit.back_off()
+        time.sleep(retry_after)
+
+
+thread_clients = threading.local()
+
+
+def get_thread_github():
+    # PyGithub shares one connection per client, so every worker gets its own client.
+    if not hasattr(thread_clients, "github"):
+        thread_clients.github = Github(get_env_var("PAT") or os.getenv("GITHUB_SCRIPT_TOKEN"), base_url=api_url, lazy=True)
+    return thread_clients.github
+
+
+def fetch_column_content_urls(column_id):
+    column = get_thread_github().get_project_column(column_id)
+    return [card.content_url for card in column.get_cards()]
+
+
+def fetch_card_content(content_url):
+    # content_url looks like https://api.github.com/repos/{owner}/{repo}/issues/{number}
+    split = content_url.split("/")
+    content = get_thread_github().get_repo("/".join(split[-4:-2])).get_issue(int(split[-1]))
+    content.complete()
+    return content
+
+
+def get_state_rest(project):
     stored = {}
-    # TODO: pagination
-    for column in project.get_columns():
+    board_issues = {}
+    limit = ConcurrencyLimit(int(get_env_var("CRAWL_CONCURRENCY") or 4))
+    columns = call_with_backoff(limit, lambda: list(lazy_github.get_project(project["id"]).get_columns()))
+
+    with ThreadPoolExecutor(max_workers=limit.limit) as executor:
+        # map keeps the board order, however the requests get scheduled.
+        content_urls = list(executor.map(lambda column: call_with_backoff(limit, fetch_column_content_urls, column.id), columns))
+        urls = [url for column_urls in content_urls for url in column_urls if url]
+        contents = dict(zip(urls, executor.map(lambda url: call_with_backoff(limit, fetch_card_content, url), urls)))
+
+    for column, column_urls in zip(columns, content_urls):
         stored[str(column.id)] = {
             "id": str(column.id),
             "name": column.name,
             "issues": {},
         }
-        # TODO: pagination
-        for card in column.get_cards():
-            content = card.get_content()
-            if content:
-                stored[str(column.id)]["issues"][str(content.id)] = {
-                    "id": str(content.id),
-                    "number": content.number,
-                    "url": content.url,
-                    "html_url": content.html_url,
-                    "title": content.title,
-                    "repo": content.repository.name,
-                    "state": content.state,
+        for url in column_urls:
+            if not url:
+                # Note card
+                continue
+            content = contents[url]
+            stored[str(column.id)]["issues"][str(content.id)] = {
+                "id": str(content.id),
+                "number": content.number,
+                "url": content.url,
+                "html_url": content.html_url,
+                "title": content.title,
+                "repo": content.html_url.split("/")[4],
+                "state": content.state,
+            }
+            board_issues[str(content.id)] = get_board_issue(content)
+    return stored, board_issues
+
+
+card_content_fragment = """
+    content {
+        __typename
+        ... on Issue {
+            databaseId
+            number
+            title
+            url
+            state
+            repository {
+                name
+                nameWithOwner
+            }
+            labels(first: 100) {
+                nodes {
+                    name
+                }
+            }
+        }
+        ... on PullRequest {
+            databaseId
+            number
+            title
+            url
+            state
+            repository {
+                name
+                nameWithOwner
+            }
+            labels(first: 100) {
+                nodes {
+                    name
                 }
-    return stored
+            }
+        }
+    }
+"""
+
+
+def fetch_project_columns_page(project, cursor, page_size):
+    after = f"after: \"{cursor}\", " if isinstance(cursor, str) else ""
+    query = gql(
+        f"""
+        query {{
+            rateLimit {{
+                cost
+            }}
+            organization(login: "{project['owner']['login']}") {{
+                project(number: {project['number']}) {{
+                    columns({after}first: {page_size}) {{
+                        pageInfo {{
+                            hasNextPage
+                            endCursor
+                        }}
+                        nodes {{
+                            id
+                            databaseId
+                            name
+                            cards(first: 100, archivedStates: [NOT_ARCHIVED]) {{
+                                pageInfo {{
+                                    hasNextPage
+                                    endCursor
+                                }}
+                                nodes {{
+                                    {card_content_fragment}
+                                }}
+                            }}
+                        }}
+                    }}
+                }}
+            }}
+        }}
+    """
+    )
+    result = run_query(query)
+    return result["organization"]["project"]["columns"]
+
+
+def fetch_column_cards_page(column_id, cursor, page_size):
+    query = gql(
+        f"""
+        query {{
+            rateLimit {{
+                cost
+            }}
+            node(id: "{column_id}") {{
+                ... on ProjectColumn {{
+                    cards(after: "{cursor}", first: {page_size}, archivedStates: [NOT_ARCHIVED]) {{
+                        pageInfo {{
+                            hasNextPage
+                            endCursor
+                        }}
+                        nodes {{
+                            {card_content_fragment}
+                        }}
+                    }}
+                }}
+            }}
+        }}
+    """
+    )
+    result = run_query(query)
+    return result["node"]["cards"]
+
+
+def get_card_id(content, url, known_ids):
+    if content["__typename"] == "Issue":
+        return str(content["databaseId"])
+    # GraphQL only has the pull request's own id. Its issue id is looked up once, after that it's in the state.
+    if url not in known_ids:
+        count("pull_request_lookups")
+        issue = lazy_github.get_repo(content["repository"]["nameWithOwner"]).get_issue(content["number"])
+        known_ids[url] = str(issue.id)
+    return known_ids[url]
+
+
+def get_card_record(content, known_ids):
+    # Keep the same shape as the REST crawl, so snapshots from either crawl can be diffed. That crawl
+    # reads pull requests through the issues API, so they get their issue id and url here too.
+    url = "%s/repos/%s/issues/%s" % (api_url, content["repository"]["nameWithOwner"], content["number"])
+    return {
+        "id": get_card_id(content, url, known_ids),
+        "number": content["number"],
+        "url": url,
+        "html_url": content["url"],
+        "title": content["title"],
+        "repo": content["repository"]["name"],
+        # The issues API reports merged pull requests as closed.
+        "state": "closed" if content["state"] == "MERGED" else content["state"].lower(),
+    }
+
+
+def get_board_issue_graphql(content, record):
+    # Comments are listed through the issue's REST url, so a lazy handle costs no request. Pull requests
+    # have one too, for their conversation comments.
+    issue = lazy_github.get_repo(content["repository"]["nameWithOwner"]).get_issue(content["number"])
+    return {
+        "id": record["id"],
+        "number": content["number"],
+        "html_url": content["url"],
+        "title": content["title"],
+        "labels": [label["name"] for label in content["labels"]["nodes"]],
+        "repo": content["repository"]["nameWithOwner"],
+        "issue": issue,
+    }
 
 
-def filter_labels(issue: Issue.Issue, labels: list):
+def get_state_graphql(project, last_state):
+    stored = {}
+    board_issues = {}
+    known_ids = {issue["url"]: issue["id"] for column in (last_state or {}).values() for issue in column["issues"].values()}
+    cursor = None
+    while True:  # fetch all pages of columns
+        print(f"Fetching columns after cursor: {cursor}")
+        with span("crawl_page"):
+            columns = fetch_project_columns_page(project, cursor, 25)
+        for column in columns["nodes"]:
+            column_id = str(column["databaseId"])
+            stored[column_id] = {
+                "id": column_id,
+                "name": column["name"],
+                "issues": {},
+            }
+            cards = column["cards"]
+            while True:  # fetch the remaining pages of cards in this column
+                for card in cards["nodes"]:
+                    content = card["content"]
+                    if content:
+                        record = get_card_record(content, known_ids)
+                        stored[column_id]["issues"][record["id"]] = record
+                        board_issues[record["id"]] = get_board_issue_graphql(content, record)
+                if not cards["pageInfo"]["hasNextPage"]:
+                    break
+                print(f" Fetching cards of column {column['name']} after cursor: {cards['pageInfo']['endCursor']}")
+                with span("crawl_page"):
+                    cards = fetch_column_cards_page(column["id"], cards["pageInfo"]["endCursor"], 100)
+
+        if not columns["pageInfo"]["hasNextPage"]:
+            break
+        cursor = columns["pageInfo"]["endCursor"]
+    return stored, board_issues
+
+
+@profiled("get_state")
+def get_state(project, last_state=None):
+    if get_env_var("CLASSIC_CRAWL") == "rest":
+        return get_state_rest(project)
+    return get_state_graphql(project, last_state)
+
+
+def filter_labels(issue_labels: list, labels: list):
     if len(labels) == 0:
         return True
     else:
-        for label in issue.labels:
-            if label.name in labels:
+        for label in issue_labels:
+            if label in labels:
                 return True
         return False
 
 
-def resolve_url(github, url):
+def fetch_project(org_login, project_number):
+    query = gql(
+        f"""
+        query {{
+            rateLimit {{
+                cost
+            }}
+            organization(login: "{org_login}") {{
+                project(number: {project_number}) {{
+                    databaseId
+                    number
+                    name
+                    url
+                    body
+                }}
+            }}
+        }}
+    """
+    )
+    result = run_query(query)
+    return result["organization"]["project"]
+
+
+def resolve_url(url):
     parsed = urllib.parse.urlparse(url)
     assert parsed.scheme == 'https', "Must be a HTTPS URL"
     assert parsed.netloc == 'github.com', "Must be on github.com"
@@ -70,11 +628,18 @@ def resolve_url(github, url):
     assert split[-2] == 'projects', "No projects found in URL"
     project_number = split[-1]
     project_org = split[-3]
-    org = github.get_organization(project_org)
-    for project in org.get_projects(state="open"):
-        if project.number == int(project_number):
-            return org, project
-    raise ValueError("Couldn't resolve project with URL %s" % (url))
+    # A direct lookup by number, instead of paging through every open project of the org.
+    project = fetch_project(project_org, int(project_number))
+    if project is None:
+        raise ValueError("Couldn't resolve project with URL %s" % (url))
+    return {
+        "id": project["databaseId"],
+        "number": project["number"],
+        "name": project["name"],
+        "html_url": project["url"],
+        "body": project["body"],
+        "owner": {"login": project_org},
+    }
 
 
 def get_threads(last_state):
@@ -87,7 +652,15 @@ def get_threads(last_state):
     return comment_threads
 
 
-def get_comments(project, last_state):
+def as_utc(value):
+    # PyGithub 2 returns aware datetimes, the stored last_read timestamps are naive UTC.
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+@profiled("get_comments")
+def get_comments(board_issues, last_state):
     if last_state is None:
         print("last_state is none, skipping")
         return {}
@@ -98,40 +671,93 @@ def get_comments(project, last_state):
                 issue_last_read[k["id"]] = k["last_read"]
 
     issue_comments = {}
-    for column in project.get_columns():
-        for card in column.get_cards():
-            content = card.get_content()
-            if content and isinstance(content, Issue.Issue):
-                print("issue %s found" % content.html_url)
-                if not filter_labels(content, labels):
-                    print("issue %s filtered" % content.html_url)
-                    continue
-                content_id = str(content.id)
-                comments = []
-                comments_update = []
-                if content_id in issue_last_read.keys():
-                    since = datetime.strptime(
-                        issue_last_read[content_id], datetime_format
-                    )
-                    print("looking for comments since %s" % since)
-                    for comment in content.get_comments(since):
-                        print("found comment %s at %s" % (comment.body, comment.created_at))
-                        if comment.created_at > since:
-                            comments.append(comment)
-                        else:
-                            comments_update.append(comment)
+    for board_issue in board_issues.values():
+        print("issue %s found" % board_issue["html_url"])
+        if not filter_labels(board_issue["labels"], labels):
+            print("issue %s filtered" % board_issue["html_url"])
+            continue
+        content_id = board_issue["id"]
+        comments = []
+        comments_update = []
+        if content_id in issue_last_read.keys():
+            since = datetime.strptime(
+                issue_last_read[content_id], datetime_format
+            )
+            print("looking for comments since %s" % since)
+            for comment in board_issue["issue"].get_comments(since):
+                print("found comment %s at %s" % (comment.body, comment.created_at))
+                if as_utc(comment.created_at) > as_utc(since):
+                    count("comments_new")
+                    comments.append(comment)
                 else:
-                    print("skipping all previous comments for %s" % content.html_url)
-
-                issue_comments[content_id] = {
-                    "id": content_id,
-                    "number": content.number,
-                    "html_url": content.html_url,
-                    "title": content.title,
-                    "comments": comments,
-                    "comments_update": comments_update,
-                    "issue": content,
-                }
+                    count("comments_updated")
+                    comments_update.append(comment)
+        else:
+            print("skipping all previous comments for %s" % board_issue["html_url"])
+
+        issue_comments[content_id] = {
+            "id": content_id,
+            "number": board_issue["number"],
+            "html_url": board_issue["html_url"],
+            "title": board_issue["title"],
+            "comments": comments,
+            "comments_update": comments_update,
+            "issue": board_issue["issue"],
+        }
+    return issue_comments
+
+
+@profiled("get_comments")
+def get_comments_by_repository(board_issues, last_state):
+    if last_state is None:
+        print("last_state is none, skipping")
+        return {}
+    issue_last_read = {}
+    for column in last_state.values():
+        for k in column["issues"].values():
+            if "last_read" in k.keys():
+                issue_last_read[k["id"]] = as_utc(datetime.strptime(k["last_read"], datetime_format))
+
+    issue_comments = {}
+    tracked = {}
+    for board_issue in board_issues.values():
+        print("issue %s found" % board_issue["html_url"])
+        if not filter_labels(board_issue["labels"], labels):
+            print("issue %s filtered" % board_issue["html_url"])
+            continue
+        content_id = board_issue["id"]
+        issue_comments[content_id] = {
+            "id": content_id,
+            "number": board_issue["number"],
+            "html_url": board_issue["html_url"],
+            "title": board_issue["title"],
+            "comments": [],
+            "comments_update": [],
+            "issue": board_issue["issue"],
+        }
+        if content_id in issue_last_read.keys():
+            tracked.setdefault(board_issue["repo"], {})[board_issue["number"]] = content_id
+        else:
+            print("skipping all previous comments for %s" % board_issue["html_url"])
+
+    # One listing per repository, starting at the oldest watermark of its issues.
+    for repo_name, issue_numbers in tracked.items():
+        since = min(issue_last_read[content_id] for content_id in issue_numbers.values())
+        print("looking for comments in %s since %s" % (repo_name, since))
+        for comment in lazy_github.get_repo(repo_name).get_issues_comments(since=since):
+            content_id = issue_numbers.get(int(comment.issue_url.rsplit("/", 1)[1]))
+            if content_id is None:
+                continue
+            issue_since = issue_last_read[content_id]
+            if as_utc(comment.updated_at) <= issue_since:
+                continue
+            print("found comment %s at %s" % (comment.html_url, comment.created_at))
+            if as_utc(comment.created_at) > issue_since:
+                count("comments_new")
+                issue_comments[content_id]["comments"].append(comment)
+            else:
+                count("comments_updated")
+                issue_comments[content_id]["comments_update"].append(comment)
     return issue_comments
 
 
@@ -140,13 +766,14 @@ def save_data(repo, project, state):
         for issue in state[column]["issues"]:
             state[column]["issues"][issue]["last_read"] = get_now()
 
-    filename = ".data/%s.json" % project.id
+    filename = ".data/%s.json" % project["id"]
     i = 1
     while True:
         try:
             content = repo.get_contents(filename)
             # TODO this will probably fail on unicode.
-            return repo.update_file(content.path, "Update", json.dumps(state), content.sha)
+            result = repo.update_file(content.path, "Update", json.dumps(state), content.sha)
+            break
         except GithubException as e:
             if e.status == 409: # 409 (Conflict) when other runs update at the same time
                 if (i <= 3):
@@ -155,12 +782,15 @@ def save_data(repo, project, state):
                     i += 1
                     continue
                 else:
-                    raise "Failed to update data content"
+                    raise Exception("Failed to update data content")
             else:
                 raise
+    # The snapshot now has everything the checkpoint had.
+    clear_checkpoint(repo, project)
+    return result
 
 def init_data(repo, project):
-    filename = ".data/%s.json" % project.id
+    filename = ".data/%s.json" % project["id"]
     try:
         repo.get_contents(filename)
     except GithubException as e:
@@ -171,12 +801,73 @@ def init_data(repo, project):
 
 
 def get_data(repo, project):
-    filename = ".data/%s.json" % project.id
-    data = repo.get_contents(filename).decoded_content.decode("utf-8")
+    filename = ".data/%s.json" % project["id"]
+    content = repo.get_contents(filename)
+    project["data_sha"] = content.sha
+    data = content.decoded_content.decode("utf-8")
     if data:
         return json.loads(data)
 
 
+def get_checkpoint_every():
+    return int(get_env_var("CHECKPOINT_EVERY") or 20)
+
+
+def get_checkpoint(repo, project):
+    """Returns the ledger of what this run delivered, seeded from a run that failed before saving its state."""
+    if "checkpoint" in project:
+        return project["checkpoint"]
+    # Tied to the snapshot the comments were looked up against.
+    checkpoint = {"base": project.get("data_sha"), "comments": {}, "updated": {}, "pending": 0}
+    project["checkpoint"] = checkpoint
+    try:
+        content = repo.get_contents(".data/%s.checkpoint.json" % project["id"])
+    except GithubException as e:
+        if e.status == 404:
+            return checkpoint
+        raise
+    project["checkpoint_sha"] = content.sha
+    stored = json.loads(content.decoded_content.decode("utf-8"))
+    if stored.get("base") != checkpoint["base"]:
+        # The state was saved since, so everything in it was delivered and is recorded there.
+        print("Ignoring the checkpoint of an older snapshot")
+        return checkpoint
+    checkpoint.update(stored)
+    print("Resuming after %s delivered comments and %s comment updates" % (
+        sum(len(x) for x in checkpoint["comments"].values()), len(checkpoint["updated"])))
+    return checkpoint
+
+
+def checkpoint_delivery(repo, project, deliveries=1):
+    checkpoint = project["checkpoint"]
+    checkpoint["pending"] += deliveries
+    if checkpoint["pending"] >= get_checkpoint_every():
+        save_checkpoint(repo, project)
+
+
+def save_checkpoint(repo, project):
+    checkpoint = project.get("checkpoint")
+    if not checkpoint or not checkpoint["pending"]:
+        return
+    filename = ".data/%s.checkpoint.json" % project["id"]
+    data = json.dumps({k: checkpoint[k] for k in ("base", "comments", "updated")})
+    if project.get("checkpoint_sha"):
+        result = repo.update_file(filename, "Checkpoint", data, project["checkpoint_sha"])
+    else:
+        result = repo.create_file(filename, "Checkpoint", data)
+    project["checkpoint_sha"] = result["content"].sha
+    checkpoint["pending"] = 0
+    count("checkpoints")
+
+
+def clear_checkpoint(repo, project):
+    if project.get("checkpoint_sha"):
+        repo.delete_file(".data/%s.checkpoint.json" % project["id"], "Clear checkpoint", project["checkpoint_sha"])
+    project.pop("checkpoint_sha", None)
+    project.pop("checkpoint", None)
+
+
+@profiled("inherit_states")
 def inherit_states(current_state, last_state):
     def get_existing_comments(last_state, id):
         if last_state is None:
@@ -196,6 +887,7 @@ def inherit_states(current_state, last_state):
     return current_state
 
 
+@profiled("diff_states")
 def diff_states(current_state, last_state):
     diffs = []
     current_state = json.loads(json.dumps(current_state))
@@ -246,24 +938,78 @@ def diff_states(current_state, last_state):
     return diffs
 
 
-def get_env_var_name(name):
-    if "LOCAL_DEV" in os.environ:
-        return name
-    else:
-        return "INPUT_%s" % name
+# Slack truncates long attachments, keep each message well below that.
+slack_message_limit = 3000
 
 
-def get_env_var(name):
-    return os.getenv(get_env_var_name(name))
+def get_digest_threshold():
+    return int(get_env_var("DIGEST_THRESHOLD") or 50)
 
-def is_env_var_present(name):
-    return get_env_var_name(name) in os.environ and get_env_var(name) != ""
+
+def format_diff(diff):
+    issue_emoji = ":issue-closed:" if diff["issue"]["state"] == "closed" else ":issue:"
+    return "%s <%s|%s> %s" % (
+        issue_emoji,
+        diff["issue"]["html_url"],
+        escape_slack_link(diff["issue"]["title"]),
+        diff["comment"],
+    )
+
+
+def get_digest_lines(diffs):
+    # One line per transition with its count and first few issues, instead of one per issue.
+    top = int(get_env_var("DIGEST_TOP") or 5)
+    transitions = {}
+    for diff in diffs:
+        transitions.setdefault(diff["comment"], []).append(diff)
+
+    lines = []
+    for transition, transition_diffs in sorted(transitions.items(), key=lambda x: len(x[1]), reverse=True):
+        links = ", ".join(
+            "<%s|%s>" % (diff["issue"]["html_url"], escape_slack_link(diff["issue"]["title"]))
+            for diff in transition_diffs[:top]
+        )
+        more = len(transition_diffs) - top
+        lines.append("*%s* %s - %s%s" % (
+            len(transition_diffs), transition, links, " and %s more" % more if more > 0 else ""))
+    return lines
+
+
+def split_messages(lines):
+    messages = []
+    current = []
+    size = 0
+    for line in lines:
+        if current and size + len(line) > slack_message_limit:
+            messages.append("\n".join(current))
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        messages.append("\n".join(current))
+    return messages
+
+
+def notify_diffs(project, diffs):
+    if len(diffs) > get_digest_threshold():
+        lines = get_digest_lines(diffs)
+    else:
+        lines = [format_diff(diff) for diff in sorted(diffs, key=lambda k: k["comment"])]
+    if description:
+        lines.insert(0, description)
+    # green if all closed, blue otherwise
+    closed = all(diff["issue"]["state"] == "closed" for diff in diffs)
+    color = "#36a64f" if closed else "#439FE0"
+    for text in split_messages(lines):
+        send_slack(project, text, color=color)
 
 
+@profiled("slack")
 def send_slack(project, text, attachment=None, color="#D3D3D3"):  # grey-ish
     if attachment is None:
         print(text)
-        footer = "Updated in project <%s|%s>" % (project.html_url, escape_slack_link(project.name))
+        footer = "Updated in project <%s|%s>" % (project["html_url"], escape_slack_link(project["name"]))
         attachment = {
             "mrkdwn_in": ["text"],
             "color": color,
@@ -271,22 +1017,30 @@ def send_slack(project, text, attachment=None, color="#D3D3D3"):  # grey-ish
             "footer": footer,
         }
 
+    count("slack_messages")
     if use_slack_api:
-        response = slack.chat_postMessage(
-            channel=channel, attachments=[attachment]
-        )
+        with span("slack"):
+            response = slack.chat_postMessage(
+                channel=channel, attachments=[attachment]
+            )
         print("...sent to channel %s" % channel)
         return response
     else:
         body = {
             "attachments": [attachment],
         }
-        response = requests.post(slack_webhook, json=body)
+        with span("slack"):
+            response = requests.post(slack_webhook, json=body)
         print("...sent to webhook")
         return None
 
 
 def convert_to_slack_markdown(gh_text):
+    with span("markdown"):
+        return convert_markdown(gh_text)
+
+
+def convert_markdown(gh_text):
     html = markdown.markdown(gh_text)
     # later convert back to \n
     html = html.replace("\n", "<br>")
@@ -301,6 +1055,7 @@ def convert_to_slack_markdown(gh_text):
     return slack_markdown
 
 
+@profiled("slack")
 def publish_comment(text, context):
     print(text)
     print(context)
@@ -317,6 +1072,7 @@ def publish_comment(text, context):
     return send_slack(project, text, attachments)
 
 
+@profiled("slack")
 def update_comment(ts, text, context):
     if not use_slack_api:
         print >> sys.stderr, "Slack Incoming Webhooks don't allow updating messages, only posting new messages is possible. Configure Slack API (SLACK_TOKEN & CHANNEL) for messages updates."
@@ -335,9 +1091,11 @@ def update_comment(ts, text, context):
             "text": slack_text,
             "footer": context,
         }
-        slack.chat_update(
-            channel=channel, ts=ts, attachments=[attachments]
-        )
+        count("slack_updates")
+        with span("slack"):
+            slack.chat_update(
+                channel=channel, ts=ts, attachments=[attachments]
+            )
     except SlackApiError as e:
         if e.response["error"] == "channel_not_found":
             slack.chat_postMessage(
@@ -347,18 +1105,49 @@ def update_comment(ts, text, context):
         else:
             raise e
 
+def record_comment(state, issue_id, comment_id, ts):
+    for column in state.values():
+        for issue in column["issues"].values():
+            if issue["id"] == issue_id:
+                issue["comments"][comment_id] = ts
+
+
+def is_comment_recorded(state, issue_id, comment_id):
+    for column in state.values():
+        if issue_id in column["issues"]:
+            return comment_id in column["issues"][issue_id].get("comments", {})
+    return False
+
+
 def main(repo, project):
-    init_data(repo, project)
+    with span("state_read"):
+        init_data(repo, project)
 
-    # Now do stuff.
-    last_state = get_data(repo, project)
-    current_state = get_state(project)
-    current_state = inherit_states(current_state, last_state)
+        # Now do stuff.
+        last_state = get_data(repo, project)
+    with span("crawl"):
+        current_state, board_issues = get_state(project, last_state)
+    count("items", sum(len(column["issues"]) for column in current_state.values()))
+    with span("inherit"):
+        current_state = inherit_states(current_state, last_state)
 
     if get_env_var("TRACK_ISSUES").lower() == 'true':
-        comments = get_comments(project, last_state)
+        with span("comments"):
+            if get_env_var("COMMENTS_BY_REPOSITORY") == "true":
+                comments = get_comments_by_repository(board_issues, last_state)
+            else:
+                comments = get_comments(board_issues, last_state)
+        if any(c["comments"] or c["comments_update"] for c in comments.values()):
+            checkpoint = get_checkpoint(repo, project)
+            for issue_id, delivered in checkpoint["comments"].items():
+                for comment_id, ts in delivered.items():
+                    record_comment(current_state, issue_id, comment_id, ts)
         for issue in comments.keys():
             for comment in comments[issue]["comments"]:
+                if is_comment_recorded(current_state, issue, str(comment.id)):
+                    # Already delivered by a run that failed to save
+                    print("skipping delivered comment %s" % comment.html_url)
+                    continue
                 context = "*%s* commented on <%s|%s>" % (
                     comment.user.login,
                     comment.html_url,
@@ -366,11 +1155,14 @@ def main(repo, project):
                 )
                 response = publish_comment(comment.body, context)
                 if response is not None:
-                    for column in current_state.values():
-                        for k in column["issues"].values():
-                            if k["id"] == issue:
-                                k["comments"][comment.id] = response["ts"]
+                    # Stored as a string, the way it reads back from the data file.
+                    record_comment(current_state, issue, str(comment.id), response["ts"])
+                    checkpoint["comments"].setdefault(issue, {})[str(comment.id)] = response["ts"]
+                    checkpoint_delivery(repo, project)
             for update in comments[issue]["comments_update"]:
+                if checkpoint["updated"].get(str(update.id)) == str(update.updated_at):
+                    print("skipping delivered update of %s" % update.html_url)
+                    continue
                 for column in current_state.values():
                     for k in column["issues"].values():
                         for id in k["comments"].keys():
@@ -381,44 +1173,24 @@ def main(repo, project):
                                     escape_slack_link(comments[issue]["title"]),
                                 )
                                 update_comment(k["comments"][id], update.body, context)
+                                checkpoint["updated"][str(update.id)] = str(update.updated_at)
+                                checkpoint_delivery(repo, project)
 
-    save_data(repo, project, current_state)
+    with span("state_write"):
+        save_data(repo, project, current_state)
 
     if not last_state:
         print("No last state found, exiting.")
         sys.exit()
 
-    diffs = diff_states(current_state, last_state)
+    with span("diff"):
+        diffs = diff_states(current_state, last_state)
+    count("diffs", len(diffs))
     if not diffs:
         print("No difference found, exiting.")
         sys.exit()
 
-
-    msgs = []
-    diffs = sorted(diffs, key=lambda k: k["comment"])
-    for diff in diffs:
-        issue_emoji = ":issue-closed:" if diff["issue"]["state"] == "closed" else ":issue:"
-        color = (
-            "#36a64f" if diff["issue"]["state"] == "closed" else "#439FE0"
-        )  # green if closed, blue otherwise
-        msgs.append(
-            "%s <%s|%s> %s"
-            % (
-                issue_emoji,
-                diff["issue"]["html_url"],
-                escape_slack_link(diff["issue"]["title"]),
-                diff["comment"],
-            )
-        )
-
-    msgs = "\n".join(msgs)
-
-    if description:
-        text = description + "\n" + msgs 
-    else:
-        text = msgs
-
-    send_slack(project, text, color=color)
+    notify_diffs(project, diffs)
 
 # Get bits
 use_slack_api = is_env_var_present("SLACK_TOKEN") and is_env_var_present("CHANNEL")
@@ -442,21 +1214,41 @@ else:
     labels = []
 
 
-slack = WebClient(token=get_env_var("SLACK_TOKEN"))
+slack = WebClient(token=get_env_var("SLACK_TOKEN"), base_url=os.getenv("SLACK_API_URL", "https://www.slack.com/api/"))
 channel = get_env_var("CHANNEL")
 slack_webhook = get_env_var("SLACK_WEBHOOK")
 
+instrument_requests()
+if http_cache_dir:
+    install_http_cache()
+project = {}
 try:
     # Subject to GitHub RateLimitExceededException
-    github = Github(get_env_var("PAT") or os.getenv("GITHUB_SCRIPT_TOKEN"))
-    repo = github.get_repo(get_env_var("REPO_FOR_DATA"))
-    org, project = resolve_url(github, get_env_var("PROJECT_URL"))
+    with span("resolve"):
+        github = Github(get_env_var("PAT") or os.getenv("GITHUB_SCRIPT_TOKEN"), base_url=api_url)
+        lazy_github = github.withLazy(True)
+        repo = github.get_repo(get_env_var("REPO_FOR_DATA"))
+
+        transport = AIOHTTPTransport(url=graphql_url, headers={
+                                     'Authorization': 'Bearer %s' % (get_env_var("PAT") or os.getenv("GITHUB_SCRIPT_TOKEN"))})
+        # Queries are validated by GitHub, downloading the schema every run only costs time.
+        gql_client = Client(transport=transport, fetch_schema_from_transport=False)
+        project = resolve_url(get_env_var("PROJECT_URL"))
 
     if get_env_var("SHOW_PROJECT_BODY").lower() == "true":
-        description = convert_to_slack_markdown(project.body)
+        description = convert_to_slack_markdown(project["body"])
     else:
         description = ""
 
     main(repo, project)
 except RateLimitExceededException:
     print("Hit GitHub RateLimitExceededException. Skipping this run.")
+finally:
+    # Only left over when the run failed before saving its state: keep what was already sent to Slack
+    # for the next run, or it sends it again.
+    if project.get("checkpoint"):
+        save_checkpoint(repo, project)
+    if http_cache_dir:
+        prune_http_cache()
+    write_profiles()
+    write_metrics(project)
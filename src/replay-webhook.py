@@ -0,0 +1,37 @@
+import hashlib
+import hmac
+import os
+import requests
+import sys
+import uuid
+
+# Posts a recorded webhook payload to a local `MODE=server` receiver, signed
+# the same way GitHub signs deliveries.
+#
+#   WEBHOOK_SECRET=... python src/replay-webhook.py http://localhost:8080 issue_comment payload.json
+
+
+def replay(url, event, filename, secret):
+    with open(filename, "rb") as f:
+        body = f.read()
+    signature = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    response = requests.post(
+        url,
+        data=body,
+        headers={
+            "Content-Type": "application/json",
+            "X-GitHub-Event": event,
+            "X-GitHub-Delivery": str(uuid.uuid4()),
+            "X-Hub-Signature-256": signature,
+        },
+    )
+    print("%s %s" % (response.status_code, response.text))
+    return response.ok
+
+
+if len(sys.argv) != 4:
+    print("Usage: replay-webhook.py <url> <event> <payload.json>")
+    sys.exit(1)
+
+if not replay(sys.argv[1], sys.argv[2], sys.argv[3], os.getenv("WEBHOOK_SECRET", "")):
+    sys.exit(1)